@@ -0,0 +1,393 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import random
+import resource
+import argparse
+import tempfile
+import tracemalloc
+from itertools import count
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web, ClientSession
+
+# 🧪 Офлайн-нагрузка на бота: фейковый Bot API + генератор апдейтов
+# python bench.py fake-api --port 8081        — только фейковый Telegram
+# python bench.py load --mode webhook -n 2000 — бот в этом процессе + нагрузка
+# python bench.py replay -n 5000 -c 8          — смешанный поток прямо через Dispatcher
+# python bench.py geo -n 10000                 — скалярная геометрия против numpy
+
+TOKEN = '42:BENCH'
+BOT_USER = {'id': 42, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.updates = []
+        self.waiters = []
+        self.calls = 0
+        self._message_ids = count(1)
+        self.on_send = None
+
+    def push(self, update):
+        self.updates.append(update)
+        self.wake()
+
+    def wake(self):
+        for fut in self.waiters:
+            if not fut.done():
+                fut.set_result(None)
+        self.waiters.clear()
+
+    async def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+        self.updates = [u for u in self.updates if u['update_id'] >= offset]
+        if not self.updates and timeout:
+            fut = asyncio.get_running_loop().create_future()
+            self.waiters.append(fut)
+            try:
+                await asyncio.wait_for(fut, timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:int(params.get('limit') or 100)]
+
+    def _send_message(self, params):
+        chat_id = int(params['chat_id'])
+        if self.on_send:
+            self.on_send(chat_id)
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+            'text': params.get('text', ''),
+        }
+
+    async def handle(self, request):
+        self.calls += 1
+        method = request.match_info['method'].lower()
+        params = dict(await request.post())
+        if method == 'getme':
+            result = BOT_USER
+        elif method == 'getupdates':
+            result = await self._get_updates(params)
+        elif method == 'sendmessage':
+            result = self._send_message(params)
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    def app(self):
+        app = web.Application(client_max_size=32 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+
+async def start_app(app, host, port):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def make_update(update_id, user_id, text=None, location=None):
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'u{user_id}'},
+    }
+    if text is not None:
+        message['text'] = text
+    if location is not None:
+        message['location'] = {'latitude': location[0], 'longitude': location[1]}
+    return {'update_id': update_id, 'message': message}
+
+
+def passenger_updates(n):
+    for i in range(n):
+        user_id = 10_000 + i
+        text = '📋 Расписание' if i % 2 else '/start'
+        yield make_update(i + 1, user_id, text=text)
+
+
+# Смешанный поток: (вид, апдейт). Доли примерно как в час пик
+SCENARIO_WEIGHTS = {'start': 2, 'schedule': 5, 'passenger_gps': 3, 'driver_gps': 1, 'admin': 0.2}
+
+
+def scenario_updates(n, bot, seed=1):
+    rnd = random.Random(seed)
+    points = next(iter(bot.registry.routes.values())).geometry.points
+    driver_id, admin_id = next(iter(bot.registry.by_driver)), bot.ADMIN_IDS[0]
+    kinds, weights = zip(*SCENARIO_WEIGHTS.items())
+    update_ids = count(1)
+
+    def point_at(share):
+        i = min(int(share * (len(points) - 1)), len(points) - 2)
+        (lat1, lon1), (lat2, lon2) = points[i], points[i + 1]
+        t = share * (len(points) - 1) - i
+        return lat1 + (lat2 - lat1) * t + rnd.gauss(0, 0.0003), lon1 + (lon2 - lon1) * t + rnd.gauss(0, 0.0003)
+
+    bus = 0.0
+    produced = 0
+    while produced < n:
+        kind = rnd.choices(kinds, weights)[0]
+        user_id = 10_000 + rnd.randrange(5_000)
+        if kind == 'start':
+            batch = [make_update(next(update_ids), user_id, text='/start')]
+        elif kind == 'schedule':
+            batch = [make_update(next(update_ids), user_id, text='📋 Расписание')]
+        elif kind == 'passenger_gps':
+            batch = [make_update(next(update_ids), user_id, location=point_at(rnd.random()))]
+        elif kind == 'driver_gps':
+            bus = (bus + 0.004) % 1
+            batch = [make_update(next(update_ids), driver_id, location=point_at(bus))]
+        else:
+            # Правка будней: кнопка и ввод времени — два апдейта подряд
+            times = ','.join(f'{h:02d}:{rnd.choice((0, 15, 30, 45)):02d}' for h in range(6, 18, 2))
+            batch = [
+                make_update(next(update_ids), admin_id, text='📋 Будни'),
+                make_update(next(update_ids), admin_id, text=times),
+            ]
+        for update in batch:
+            produced += 1
+            yield kind, update
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def latency_stats(latencies):
+    return {
+        'count': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'max_ms': round(max(latencies, default=0) * 1000, 2),
+    }
+
+
+def max_rss_mb():
+    # ru_maxrss в Linux — КиБ
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def import_bot(args, mode):
+    # Бот импортируется после настройки окружения и работает во временном каталоге
+    os.environ.update({
+        'BOT_TOKEN': TOKEN,
+        'BOT_API_URL': f'http://127.0.0.1:{args.api_port}',
+        'BOT_MODE': mode,
+        'WEBHOOK_HOST': '127.0.0.1',
+        'WEBHOOK_PORT': str(getattr(args, 'webhook_port', 8082)),
+        'WEBHOOK_SECRET': 'bench-secret',
+        'METRICS_PORT': '0',
+        'SEND_RATE': '0',
+    })
+    os.chdir(tempfile.mkdtemp(prefix='avtobus-bench-'))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+    logging.getLogger().setLevel(logging.WARNING)
+    return bot
+
+
+async def run_load(args):
+    fake = FakeTelegram()
+    api_runner = await start_app(fake.app(), '127.0.0.1', args.api_port)
+    bot = import_bot(args, args.mode)
+
+    started, latencies = {}, []
+    done = asyncio.Event()
+
+    def on_send(chat_id):
+        t0 = started.pop(chat_id, None)
+        if t0 is not None:
+            latencies.append(time.perf_counter() - t0)
+            if len(latencies) == args.n:
+                done.set()
+
+    fake.on_send = on_send
+    bot_task = asyncio.create_task(bot.main())
+    await asyncio.sleep(0.5)
+
+    t_start = time.perf_counter()
+    async with ClientSession() as http:
+        for update in passenger_updates(args.n):
+            started[update['message']['chat']['id']] = time.perf_counter()
+            if args.mode == 'webhook':
+                await http.post(
+                    f'http://127.0.0.1:{args.webhook_port}{bot.WEBHOOK_PATH}',
+                    json=update,
+                    headers={'X-Telegram-Bot-Api-Secret-Token': 'bench-secret'},
+                )
+            else:
+                fake.push(update)
+        try:
+            await asyncio.wait_for(done.wait(), args.timeout)
+        except asyncio.TimeoutError:
+            pass
+    elapsed = time.perf_counter() - t_start
+
+    if args.mode == 'polling':
+        await bot.dp.stop_polling()
+    else:
+        bot_task.cancel()
+    await asyncio.gather(bot_task, return_exceptions=True)
+    fake.wake()
+    await api_runner.cleanup()
+
+    print(json.dumps({
+        'mode': args.mode,
+        'updates': args.n,
+        'answered': len(latencies),
+        'seconds': round(elapsed, 3),
+        'updates_per_sec': round(len(latencies) / elapsed, 1),
+        'mean_latency_ms': round(sum(latencies) / max(len(latencies), 1) * 1000, 2),
+        **latency_stats(latencies),
+        'api_calls': fake.calls,
+        'max_rss_mb': max_rss_mb(),
+    }, ensure_ascii=False))
+
+
+async def run_replay(args):
+    # Апдейты идут прямо в Dispatcher.feed_raw_update; ответы бота — в фейковый Bot API.
+    # Апдейты одного пользователя обрабатывает один воркер, по порядку — как при polling
+    fake = FakeTelegram()
+    api_runner = await start_app(fake.app(), '127.0.0.1', args.api_port)
+    bot = import_bot(args, 'polling')
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(bot.IO_WORKERS, thread_name_prefix='io'))
+    bot.init_schedule()
+    bot.init_registry()
+    bot.schedule_store.start()
+    notifier_task = asyncio.create_task(bot.notifier.run())
+
+    stream = list(scenario_updates(args.n, bot, args.seed))
+    queues = [asyncio.Queue() for _ in range(args.concurrency)]
+    for kind, update in stream:
+        queues[update['message']['from']['id'] % args.concurrency].put_nowait((kind, update))
+    latencies = {kind: [] for kind in SCENARIO_WEIGHTS}
+
+    async def worker(queue):
+        while not queue.empty():
+            kind, update = queue.get_nowait()
+            t0 = time.perf_counter()
+            await bot.dp.feed_raw_update(bot.bot, update)
+            latencies[kind].append(time.perf_counter() - t0)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    t_start = time.perf_counter()
+    await asyncio.gather(*(worker(queue) for queue in queues))
+    elapsed = time.perf_counter() - t_start
+    traced_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+    tracemalloc.stop()
+
+    notifier_task.cancel()
+    await bot.schedule_store.close()
+    await bot.bot.session.close()
+    bot.registry.close()
+    await api_runner.cleanup()
+
+    everything = [x for values in latencies.values() for x in values]
+    print(json.dumps({
+        'mode': 'replay',
+        'updates': len(stream),
+        'concurrency': args.concurrency,
+        'seconds': round(elapsed, 3),
+        'updates_per_sec': round(len(stream) / elapsed, 1),
+        **latency_stats(everything),
+        'by_kind': {kind: latency_stats(values) for kind, values in latencies.items() if values},
+        'api_calls': fake.calls,
+        'max_rss_mb': max_rss_mb(),
+        'traced_peak_mb': round(traced_peak / 2 ** 20, 1) if traced_peak is not None else None,
+    }, ensure_ascii=False, indent=2))
+
+
+def run_geo(args):
+    import random
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from geo import haversine, haversine_many, np
+    from route import Route, SegmentSpeeds, batch_eta
+
+    rnd = random.Random(1)
+    lats = [rnd.uniform(50.96, 51.09) for _ in range(args.n)]
+    lons = [rnd.uniform(44.76, 44.83) for _ in range(args.n)]
+    # Извилистая ломаная на ~200 вершин вместо прямой по умолчанию
+    points = [(50.976 + i * 0.00053, 44.777 + 0.004 * ((i % 20) / 20)) for i in range(200)]
+    route = Route(points)
+    speeds = SegmentSpeeds(route)
+    bus_progress = 40.0
+
+    def timed(fn):
+        t0 = time.perf_counter()
+        fn()
+        return round((time.perf_counter() - t0) * 1000, 2)
+
+    def scalar_eta():
+        bus_km = route.km_at(bus_progress)
+        return [speeds.travel_minutes(bus_km, route.project(lat, lon)[0]) for lat, lon in zip(lats, lons)]
+
+    print(json.dumps({
+        'points': args.n,
+        'numpy': np is not None,
+        'haversine_scalar_ms': timed(lambda: [haversine(a, b, 51.0, 44.8) for a, b in zip(lats, lons)]),
+        'haversine_batch_ms': timed(lambda: haversine_many(lats, lons, 51.0, 44.8)),
+        'eta_scalar_ms': timed(scalar_eta),
+        'eta_batch_ms': timed(lambda: batch_eta(route, speeds, bus_progress, lats, lons)),
+    }))
+
+
+async def run_fake_api(args):
+    runner = await start_app(FakeTelegram().app(), args.host, args.port)
+    print(f"🧪 Фейковый Bot API: http://{args.host}:{args.port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Офлайн-нагрузка на бота автобуса')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    fake = sub.add_parser('fake-api', help='запустить фейковый Bot API')
+    fake.add_argument('--host', default='127.0.0.1')
+    fake.add_argument('--port', type=int, default=8081)
+
+    load = sub.add_parser('load', help='прогнать апдейты через бота')
+    load.add_argument('--mode', choices=['polling', 'webhook'], default='polling')
+    load.add_argument('-n', type=int, default=1000)
+    load.add_argument('--api-port', type=int, default=8081)
+    load.add_argument('--webhook-port', type=int, default=8082)
+    load.add_argument('--timeout', type=float, default=60)
+
+    replay = sub.add_parser('replay', help='смешанный поток апдейтов прямо через Dispatcher')
+    replay.add_argument('-n', type=int, default=5000)
+    replay.add_argument('-c', '--concurrency', type=int, default=8)
+    replay.add_argument('--seed', type=int, default=1)
+    replay.add_argument('--api-port', type=int, default=8081)
+    replay.add_argument('--tracemalloc', action='store_true', help='пик памяти Python (медленнее)')
+
+    geo = sub.add_parser('geo', help='сравнить скалярную и пакетную геометрию')
+    geo.add_argument('-n', type=int, default=10_000)
+
+    args = parser.parse_args()
+    if args.command == 'fake-api':
+        asyncio.run(run_fake_api(args))
+    elif args.command == 'geo':
+        run_geo(args)
+    elif args.command == 'replay':
+        asyncio.run(run_replay(args))
+    else:
+        asyncio.run(run_load(args))
+
+
+if __name__ == '__main__':
+    main()
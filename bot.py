@@ -1,27 +1,117 @@
 import os
 import asyncio
-import json
 import logging
+import time
+import zipfile
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from math import radians, sin, cos, sqrt, atan2
 
+from aiohttp import web
 from aiogram import Bot, Dispatcher, F
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton, Location
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton, Location, BufferedInputFile
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.exceptions import TelegramAPIError
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from store import ScheduleStore, VersionConflict, make_backend
+from timetable import TimetableResolver, fmt_minutes, to_minutes, parse_period, fmt_period, expired_ops
+from fsm_storage import make_fsm_storage
+from notify import ArrivalNotifier, SendLimiter
+from registry import build_registry
+from ingest import FixChannel, FixIngest
+from trips import TripHistory, ON_TIME_MIN
+from metrics import Metrics, HandlerTimingMiddleware, UpdateCounterMiddleware, TimedStorage
+from throttle import ThrottlingMiddleware, ReplyReuseMiddleware, SendQueueMiddleware
+from timetable_io import detect_format, import_timetable, export_timetable, export_routes, parse_time_list
 
 API_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_IDS = [1135333763]  # Твой Telegram ID
 DRIVER_ID = 1135333753   # ID водителя
 
+# Режим работы: polling (по умолчанию) или webhook за reverse proxy
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+BOT_API_URL = os.getenv('BOT_API_URL')  # свой Bot API сервер, например фейковый из bench.py
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # внешний адрес, например https://bus.example.ru
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')  # обязателен в режиме webhook
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+
+# Хранилище FSM: sqlite (по умолчанию), redis или memory
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'sqlite')
+FSM_SQLITE_PATH = os.getenv('FSM_SQLITE_PATH', 'fsm.sqlite3')
+FSM_REDIS_URL = os.getenv('FSM_REDIS_URL')  # redis://localhost:6379/0
+FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', '86400')) or None  # сек, 0 — без срока
+NOTIFY_APPROACH_KM = float(os.getenv('NOTIFY_APPROACH_KM', '2'))  # за сколько км предупреждать
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9101'))  # /metrics для Prometheus, 0 — выключить
+SEND_RATE = float(os.getenv('SEND_RATE', '30'))  # сообщений/с на весь бот, 0 — без лимита
+MAX_IMPORT_BYTES = 20 * 2 ** 20  # больше Bot API всё равно не отдаёт
+
+# Пассажирские запросы: (в секунду, запас) на пользователя и сколько секунд отдавать прошлый ответ
+PASSENGER_THROTTLE = (0.5, 4)
+PASSENGER_REUSE_SEC = 15
+
 # Инициализация
 logging.basicConfig(level=logging.INFO)
-bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+session = AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL)) if BOT_API_URL else None
+bot = Bot(token=API_TOKEN, session=session)
+# Все исходящие сообщения — через общую очередь с лимитами Telegram (группы — не чаще раза в 3 с)
+bot.session.middleware(SendQueueMiddleware(SendLimiter(SEND_RATE, private_interval=0)))
+storage = make_fsm_storage(FSM_STORAGE, FSM_SQLITE_PATH, FSM_REDIS_URL, FSM_STATE_TTL)
+# Несколько воркеров на одном Redis должны блокировать апдейты одного пользователя
+isolation = storage.create_isolation() if hasattr(storage, 'create_isolation') else None
+
+# 📈 Метрики
+metrics = Metrics()
+handler_seconds = metrics.histogram('bot_handler_seconds', 'Время работы хендлера', ('handler',))
+updates_total = metrics.counter('bot_updates_total', 'Принято апдейтов', ('type',))
+storage_seconds = metrics.histogram('bot_storage_seconds', 'Время обращений к хранилищам', ('storage', 'op'))
+
+dp = Dispatcher(storage=TimedStorage(storage, storage_seconds), events_isolation=isolation)
+dp.update.outer_middleware(UpdateCounterMiddleware(updates_total))
+for observer in (dp.message, dp.edited_message, dp.callback_query):
+    observer.middleware(HandlerTimingMiddleware(handler_seconds))
+dp.message.middleware(ThrottlingMiddleware())
+dp.message.middleware(ReplyReuseMiddleware(version=lambda: timetable.version))
 SCHEDULE_FILE = Path('schedule.json')
+SCHEDULE_DB = Path(os.getenv('SCHEDULE_DB', 'schedule.sqlite3'))
+SCHEDULE_BACKEND = os.getenv('SCHEDULE_BACKEND', 'sqlite')  # sqlite (schedule.json переносится сам) или json
+SCHEDULE_FLUSH_INTERVAL = float(os.getenv('SCHEDULE_FLUSH_INTERVAL', '2'))  # сек, 0 — писать сразу
+IO_WORKERS = int(os.getenv('IO_WORKERS', '4'))  # потоков для файлов и SQLite
+GPS_ARCHIVE_DAYS = float(os.getenv('GPS_ARCHIVE_DAYS', '30'))  # сколько дней хранить историю GPS в SQLite, 0 — всегда
+SPEED_SEED_HOURS = float(os.getenv('SPEED_SEED_HOURS', '48'))  # по скольким часам истории учить скорости при старте
+schedule_store = ScheduleStore(
+    make_backend(SCHEDULE_BACKEND, SCHEDULE_FILE, SCHEDULE_DB, GPS_ARCHIVE_DAYS), SCHEDULE_FLUSH_INTERVAL,
+    observe=lambda op, seconds: storage_seconds.observe(seconds, 'schedule', op),
+)
+# 👥 Несколько воркеров: общие только FSM (Redis) и база расписания (правки других подхватываются).
+# GPS, уведомления и история рейсов у каждого воркера свои — отдельные файлы по WORKER_ID;
+# пассажир видит автобус, только если отметки водителя попадают в тот же воркер
+WORKER_ID = os.getenv('WORKER_ID', '')
+WORKER_SUFFIX = f'_{WORKER_ID}' if WORKER_ID else ''
+GPS_FILE = Path(f'bus_position{WORKER_SUFFIX}.bin')
+GPS_HISTORY_SIZE = int(os.getenv('GPS_HISTORY_SIZE', '256'))  # сколько последних отметок хранить
+TRIPS_DIR = Path(os.getenv('TRIPS_DIR', f'trips{WORKER_SUFFIX}'))  # история рейсов: каталог на маршрут
+TRIP_STATS_INTERVAL = float(os.getenv('TRIP_STATS_INTERVAL', '60'))  # сек между пересчётами статистики рейсов
+ROUTE_FILE = Path(os.getenv('ROUTE_FILE', 'route.geojson'))  # GeoJSON или CSV (lat,lon,name)
+
+# Маршрут и автобус по умолчанию, если в schedule.json нет разделов 'маршруты' / 'транспорт'
+DEFAULT_ROUTES = {
+    "main": {
+        "название": "Жирновск ↔ Медведица",
+        "направления": ["Жирновск→Медведица", "Медведица→Жирновск"],
+        "падежи": {
+            "Жирновск": {"где": "в Жирновске", "род": "Жирновска", "дат": "Жирновску"},
+            "Медведица": {"где": "в Медведице", "род": "Медведицы", "дат": "Медведице"}
+        }
+    }
+}
+DEFAULT_VEHICLES = {"bus": {"маршрут": "main", "водитель": DRIVER_ID}}
 
 # Состояния FSM
 class AdminStates(StatesGroup):
@@ -29,13 +119,15 @@ class AdminStates(StatesGroup):
     waiting_saturday = State()
     waiting_holiday_date = State()
     waiting_notify_chat = State()
+    waiting_trip_changes = State()
 
-# 🗄️ Работа с JSON
+# 🗄️ Хранение расписания
 def init_schedule():
-    if not SCHEDULE_FILE.exists():
+    backend = schedule_store.backend
+    if backend.is_empty():
         default_schedule = {
             "notify_chat": None,
-            "автобус_позиция": {},
+            "подписчики": {},
             "настройки": {
                 "расстояние_км": 13.3,
                 "скорость_кмч": 45,
@@ -52,80 +144,154 @@ def init_schedule():
                 }
             },
             "изменения": {},
+            "отклонения": {},
             "праздники": ["2026-01-01", "2026-02-23", "2026-03-08", "2026-05-01", "2026-05-09"]
         }
-        with open(SCHEDULE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(default_schedule, f, ensure_ascii=False, indent=2)
+        backend.write(backend.snapshot(default_schedule))
+    schedule_store.load()
 
 def load_schedule():
-    with open(SCHEDULE_FILE, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    return schedule_store.load()
 
-def save_schedule(data):
-    with open(SCHEDULE_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+# В хендлерах — только эти: чтение и запись уходят в пул потоков,
+# правки — маленькими патчами, одновременные сохранения склеиваются в одну запись
+async def aload_schedule():
+    return await schedule_store.aload()
 
-def get_day_type(date_str=None):
-    if not date_str:
-        date_str = datetime.now().strftime('%Y-%m-%d')
-    
-    dt = datetime.strptime(date_str, '%Y-%m-%d')
-    weekday = dt.weekday()
-    data = load_schedule()
-    
-    if date_str in data.get('праздники', []):
-        return 'выходной'
-    if weekday == 6:
-        return 'выходной'
-    if weekday == 5:
-        return 'суббота'
-    return 'будни'
+async def patch_schedule(*ops, expected=None, wait=True):
+    return await schedule_store.patch(ops, expected, wait)
 
-def get_schedule(direction, date_str=None):
-    day_type = get_day_type(date_str)
-    if day_type == 'выходной':
-        return []
-    
-    data = load_schedule()
-    base_times = data['базовое_расписание'][day_type][direction]
-    
-    date_changes = data['изменения'].get(date_str, {})
-    if direction in date_changes:
-        return date_changes[direction]
-    
-    return base_times
+async def patch_timetable(*ops):
+    # Правки замен и отклонений заодно убирают прошедшие, чтобы разделы не росли бесконечно
+    data = await aload_schedule()
+    return await patch_schedule(*expired_ops(data, datetime.now().strftime('%Y-%m-%d')), *ops)
 
-def haversine(lat1, lon1, lat2, lon2):
-    R = 6371
-    dlat = radians(lat2 - lat1)
-    dlon = radians(lon2 - lon1)
-    a = sin(dlat/2)**2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon/2)**2
-    c = 2 * atan2(sqrt(a), sqrt(1-a))
-    return R * c
+timetable = TimetableResolver(load_schedule)
+TIMETABLE_KEYS = {'базовое_расписание', 'изменения', 'отклонения', 'праздники'}
 
-def get_user_progress_on_route(lat, lon):
-    zhirnovsk = (50.976412, 44.777647)
-    medveditsa = (51.082652, 44.816874)
-    
-    total_distance = haversine(*zhirnovsk, *medveditsa)
-    dist_start = haversine(lat, lon, *zhirnovsk)
-    progress = min(dist_start / total_distance * 100, 100)
-    
-    return progress, dist_start
+def on_schedule_change(version, keys):
+    # Подписки пассажиров и чат уведомлений не сбрасывают кэш расписания
+    if keys is None or keys & TIMETABLE_KEYS:
+        timetable.invalidate()
+
+schedule_store.on_change(on_schedule_change)
+
+def planned_departures(direction, date_str):
+    day = timetable.day(date_str)
+    return day.day_type, day.departures.get(direction, ())
+
+# 🏁 Пройденные рейсы и выученные по ним опоздания и время в пути
+trip_history = TripHistory(TRIPS_DIR, planned_departures, TRIP_STATS_INTERVAL)
+registry = None
+notifier = None
+# 📡 Отметки водителей: отсев и сглаживание → канал, из него читают ETA и уведомления
+fix_channel = FixChannel()
+fix_ingest = FixIngest(fix_channel)
 
-def calculate_real_eta(user_lat, user_lon):
+def init_registry():
+    global registry, notifier
     data = load_schedule()
-    bus_pos = data.get('автобус_позиция', {})
-    
-    if bus_pos and 'время' in bus_pos:
-        pos_time = datetime.fromisoformat(bus_pos['время'])
-        if (datetime.now() - pos_time).seconds < 300:
-            dist_to_user = haversine(user_lat, user_lon, bus_pos['lat'], bus_pos['lon'])
-            speed_kmh = data['настройки'].get('скорость_кмч', 45)
-            minutes = max(1, int(dist_to_user / (speed_kmh / 60)))
+    registry = build_registry(
+        data.get('маршруты') or DEFAULT_ROUTES,
+        data.get('транспорт') or DEFAULT_VEHICLES,
+        data['настройки'].get('скорость_кмч', 45),
+        ROUTE_FILE, GPS_FILE, GPS_HISTORY_SIZE, WORKER_SUFFIX,
+        history=lambda vehicle_id: schedule_store.backend.fixes(vehicle_id, time.time() - SPEED_SEED_HOURS * 3600),
+    )
+    
+    notifier = ArrivalNotifier(bot, load_schedule, None, NOTIFY_APPROACH_KM)
+    fix_channel.subscribe(notifier.feed)
+    trip_history.load(registry.routes)
+    fix_channel.subscribe(trip_history.feed)
+
+def gps_fix_age():
+    now = time.time()
+    return {(v.id,): round(now - fix.time, 1) for v in registry.vehicles.values() if (fix := v.positions.last())}
+
+async def fsm_state_counts():
+    if not hasattr(storage, 'count_states'):
+        return {}
+    return {(state,): n for state, n in (await storage.count_states()).items()}
+
+metrics.gauge('bot_gps_fix_age_seconds', 'Возраст последней отметки автобуса', ('vehicle',), gps_fix_age)
+metrics.gauge('bot_fsm_states', 'Пользователей в состояниях FSM', ('state',), fsm_state_counts)
+
+async def start_metrics():
+    if not METRICS_PORT:
+        return None
+    runner = web.AppRunner(metrics.app(), access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        logging.error(f"Метрики недоступны ({e})")
+        await runner.cleanup()
+        return None
+    print(f"📈 Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+def get_day_type(date_str=None):
+    if not date_str:
+        date_str = datetime.now().strftime('%Y-%m-%d')
+    return timetable.day(date_str).day_type
+
+def get_schedule(direction, date_str=None):
+    if not date_str:
+        date_str = datetime.now().strftime('%Y-%m-%d')
+    return timetable.day(date_str).labels.get(direction, ())
+
+def route_fix(info):
+    # Самая свежая отметка среди автобусов маршрута → (автобус, отметка)
+    best = (None, None)
+    for vehicle in registry.vehicles_of(info.id):
+        fix = fix_channel.latest(vehicle.id) or vehicle.positions.last()
+        if fix and (best[1] is None or fix.time > best[1].time):
+            best = (vehicle, fix)
+    return best
+
+def calculate_real_eta(info, user_km):
+    _, bus_pos = route_fix(info)
+    today = datetime.now().strftime('%Y-%m-%d')
+    day_type = get_day_type(today)
+    # Пассажир в первой половине едет «туда», во второй — обратно
+    direction = 0 if user_km < info.geometry.length / 2 else 1
+    stats = trip_history.stats(info.id)
+    
+    if bus_pos:
+        if time.time() - bus_pos.time < 300:
+            bus_km = info.geometry.km_at(bus_pos.progress)
+            minutes = max(1, int(info.speeds.travel_minutes(bus_km, user_km)))
+            # Разброс как у прошлых рейсов: p90 / медиана времени в пути
+            spread = stats.duration(day_type, direction)
+            worst = int(minutes * spread[1] / spread[0]) if spread and spread[0] > 0 else minutes
+            if worst > minutes:
+                return f"{minutes}–{worst} мин (GPS)"
             return f"{minutes} мин (GPS)"
     
-    return "по графику (~18мин)"
+    # Без GPS — ближайший рейс с его обычным опозданием и временем в пути
+    terminal_km = 0 if direction == 0 else info.geometry.length
+    ride = info.speeds.travel_minutes(terminal_km, user_km)
+    spread = stats.duration(day_type, direction)
+    if spread:
+        ride = spread[0] * abs(user_km - terminal_km) / info.geometry.length
+    now = datetime.now()
+    now_minute = now.hour * 60 + now.minute
+    for departure in timetable.day(today).departures.get(info.directions[direction], ()):
+        delay = stats.delay(day_type, direction, departure) or stats.delay(day_type, direction) or (0, 0)
+        arrival = departure + delay[0] + ride
+        if arrival >= now_minute:
+            wait, latest = round(arrival - now_minute), round(departure + delay[1] + ride - now_minute)
+            until = f", до {latest} мин" if latest > wait else ""
+            return f"~{wait} мин (рейс {fmt_minutes(departure)}{until})"
+    
+    return "сегодня рейсов больше нет"
+
+def departure_line(info, day_type, direction, label):
+    # «• 08:00», а если этот рейс обычно опаздывает — «• 08:00 (обычно +3, до +8 мин)»
+    spread = trip_history.stats(info.id).delay(day_type, info.directions.index(direction), to_minutes(label))
+    if spread is None or spread[1] <= 1:
+        return f'• {label}'
+    return f'• {label} (обычно {spread[0]:+d}, до {spread[1]:+d} мин)'
 
 # 🛡️ Проверка админа
 def is_admin(user_id: int) -> bool:
@@ -134,10 +300,11 @@ def is_admin(user_id: int) -> bool:
 # 📱 ГЛАВНОЕ МЕНЮ
 @dp.message(F.text == '/start')
 async def start_handler(msg: Message):
-    text = "🚌 Бот расписания Жирновск ↔ Медведица"
+    text = "🚌 Бот расписания " + ", ".join(info.name for info in registry.routes.values())
     kb = ReplyKeyboardMarkup(keyboard=[
         [KeyboardButton(text="📋 Расписание")],
-        [KeyboardButton(text="📍 Моя геолокация", request_location=True)]
+        [KeyboardButton(text="📍 Моя геолокация", request_location=True)],
+        [KeyboardButton(text="🔔 Уведомления")]
     ], resize_keyboard=True)
     
     if is_admin(msg.from_user.id):
@@ -146,7 +313,60 @@ async def start_handler(msg: Message):
     
     await msg.answer(text, reply_markup=kb)
 
-@dp.message(F.text == "📋 Расписание")
+# 🖼️ Кэш ответа «Расписание»: статичная часть по (дата, версия расписания),
+# строка GPS — по номеру последней отметки автобуса маршрута
+_schedule_text_cache = {}
+_gps_status_cache = {}
+
+def render_schedule_parts(today):
+    key = (today, timetable.version, tuple(trip_history.stats(route_id).version for route_id in registry.routes))
+    parts = _schedule_text_cache.get(key)
+    if parts is None:
+        day_type = get_day_type(today)
+        day_name = {'будни': 'Будни', 'суббота': 'Суббота'}[day_type]
+        head = f"""📅 {datetime.strptime(today, '%Y-%m-%d').strftime('%d.%m.%Y')} ({day_name})
+
+📍 """
+        blocks = {}
+        for info in registry.routes.values():
+            tail = ''.join(f"""
+
+🚌 {direction.replace('→', ' → ')}:
+{chr(10).join([departure_line(info, day_type, direction, t) for t in get_schedule(direction, today)])}""" for direction in info.directions)
+            blocks[info.id] = (info, tail)
+        if len(_schedule_text_cache) >= 16:
+            _schedule_text_cache.clear()
+        parts = _schedule_text_cache[key] = (head, blocks)
+    return parts
+
+def gps_status_line(info):
+    vehicle, bus_pos = route_fix(info)
+    if not bus_pos:
+        return "📴 GPS автобуса недоступен"
+    
+    time_diff = (time.time() - bus_pos.time) / 60
+    if time_diff >= 5:
+        return f"📴 GPS устарел ({time_diff:.0f}мин)"
+    
+    key = (vehicle.id, vehicle.positions.seq)
+    cached = _gps_status_cache.get(info.id)
+    if cached and cached[0] == key:
+        return cached[1]
+    
+    progress = bus_pos.progress
+    dist_from_start = info.geometry.km_at(progress)
+    
+    if progress < 50:
+        eta_end = int(info.speeds.travel_minutes(dist_from_start, info.geometry.length))
+        gps_status = f"📍 Автобус → {info.end} ({progress:.0f}%) через {eta_end} мин"
+    else:
+        eta_start = int(info.speeds.travel_minutes(dist_from_start, 0))
+        gps_status = f"📍 Автобус → {info.start} ({progress:.0f}%) через {eta_start} мин"
+    
+    _gps_status_cache[info.id] = (key, gps_status)
+    return gps_status
+
+@dp.message(F.text == "📋 Расписание", flags={'throttle': PASSENGER_THROTTLE, 'reuse': PASSENGER_REUSE_SEC})
 async def show_schedule(msg: Message):
     today = datetime.now().strftime('%Y-%m-%d')
     day_type = get_day_type(today)
@@ -155,48 +375,70 @@ async def show_schedule(msg: Message):
         await msg.answer("🛑 Сегодня выходной день. Рейсов нет.")
         return
     
-    to_med = get_schedule("Жирновск→Медведица", today)
-    back = get_schedule("Медведица→Жирновск", today)
-    
-    data = load_schedule()
-    bus_pos = data.get('автобус_позиция', {})
-    gps_status = "📴 GPS автобуса недоступен"
-    
-    if bus_pos and 'время' in bus_pos:
-        pos_time = datetime.fromisoformat(bus_pos['время'])
-        time_diff = (datetime.now() - pos_time).seconds / 60
-        
-        if time_diff < 5:
-            progress = bus_pos.get('прогресс', 0)
-            dist_from_start = 13.3 * progress / 100
-            
-            if progress < 50:
-                eta_medveditsa = int((13.3 - dist_from_start) / (45/60))
-                gps_status = f"📍 Автобус → Медведица ({progress:.0f}%) через {eta_medveditsa} мин"
-            else:
-                dist_to_zhirovsk = 13.3 - dist_from_start
-                eta_zhirovsk = int(dist_to_zhirovsk / (45/60))
-                gps_status = f"📍 Автобус → Жирновск ({progress:.0f}%) через {eta_zhirovsk} мин"
-        else:
-            gps_status = f"📴 GPS устарел ({time_diff:.0f}мин)"
-    
-    day_name = {'будни': 'Будни', 'суббота': 'Суббота'}[day_type]
-    text = f"""📅 {datetime.now().strftime('%d.%m.%Y')} ({day_name})
-
-📍 {gps_status}
+    # По сообщению на маршрут: все маршруты сразу не влезают в 4096 символов
+    if len(registry.routes) > 1:
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=f"🛣️ {info.name}", callback_data=f"schedule:{info.id}")]
+            for info in registry.routes.values()
+        ])
+        await msg.answer("🚌 Выберите маршрут:", reply_markup=kb)
+        return
+    await msg.answer(render_route_schedule(today, next(iter(registry.routes))))
 
-🚌 Жирновск → Медведица:
-{chr(10).join([f'• {t}' for t in to_med])}
+def render_route_schedule(today, route_id):
+    head, blocks = render_schedule_parts(today)
+    info, tail = blocks[route_id]
+    return head + gps_status_line(info) + tail
 
-🚌 Медведица → Жирновск:
-{chr(10).join([f'• {t}' for t in back])}"""
+@dp.callback_query(F.data.startswith("schedule:"))
+async def show_route_schedule(call: CallbackQuery):
+    route_id = call.data.removeprefix("schedule:")
+    today = datetime.now().strftime('%Y-%m-%d')
+    if route_id not in registry.routes or get_day_type(today) == 'выходной':
+        await call.answer("Нет рейсов", show_alert=True)
+        return
+    await call.message.answer(render_route_schedule(today, route_id))
+    await call.answer()
+
+def is_driver(msg: Message):
+    return msg.from_user is not None and msg.from_user.id in registry.by_driver
+
+def ingest_driver_fix(msg: Message):
+    # Время отметки — из Telegram: у живой геопозиции это время правки сообщения
+    vehicle = registry.by_driver[msg.from_user.id]
+    info = vehicle.route
+    prev = fix_channel.latest(vehicle.id) or vehicle.positions.last()
+    ts = msg.edit_date or msg.date.timestamp()
+    loc = msg.location
+    sample = fix_ingest.accept(vehicle, loc.latitude, loc.longitude, ts, loc.horizontal_accuracy)
+    if sample is None:
+        return None
+    schedule_store.record_fix(vehicle.id, sample)
+    if prev:
+        info.speeds.learn(info.geometry.km_at(prev.progress), prev.time, info.geometry.km_at(sample.progress), sample.time)
+    return sample
+
+# Водитель — без лимитов: каждая отметка важна
+@dp.message(F.location, is_driver)
+async def driver_location(msg: Message):
+    if get_day_type() == 'выходной':
+        await msg.answer("🛑 Сегодня выходной.")
+        return
     
-    await msg.answer(text)
+    if ingest_driver_fix(msg) is None:
+        await msg.answer("⚠️ Отметка не принята: она старше последней или слишком далеко от неё. Отправьте геопозицию ещё раз.")
+        return
+    await msg.answer("✅ GPS обновлён! Пассажиры видят вас.")
 
-@dp.message(F.location)
-async def handle_location(msg: Location):
+# Живая геопозиция приходит правками сообщения — принимаем молча
+@dp.edited_message(F.location, is_driver)
+async def driver_live_location(msg: Message):
+    if get_day_type() != 'выходной':
+        ingest_driver_fix(msg)
+
+@dp.message(F.location, flags={'throttle': PASSENGER_THROTTLE, 'reuse': PASSENGER_REUSE_SEC})
+async def handle_location(msg: Message):
     lat, lon = msg.location.latitude, msg.location.longitude
-    progress, dist_start = get_user_progress_on_route(lat, lon)
     
     today = datetime.now().strftime('%Y-%m-%d')
     day_type = get_day_type(today)
@@ -205,38 +447,56 @@ async def handle_location(msg: Location):
         await msg.answer("🛑 Сегодня выходной.")
         return
     
-    # Водитель
-    if msg.from_user.id == DRIVER_ID:
-        data = load_schedule()
-        data['автобус_позиция'] = {
-            'lat': lat, 'lon': lon,
-            'время': datetime.now().isoformat(),
-            'прогресс': progress
-        }
-        save_schedule(data)
-        await msg.answer("✅ GPS обновлён! Пассажиры видят вас.")
-        return
-    
     # Пассажир
-    eta = calculate_real_eta(lat, lon)
-    
-    if dist_start < 6.65:
-        times = get_schedule("Жирновск→Медведица", today)
-        text = f"""📍 Вы в Жирновске ({progress:.0f}%)
-🚌 До Медведицы: {', '.join(times) or 'нет рейсов'}
+    info, dist_start, _ = registry.locate(lat, lon)
+    progress = dist_start / info.geometry.length * 100
+    eta = calculate_real_eta(info, dist_start)
+    
+    # Подписчику запоминаем остановку, чтобы предупреждать именно о ней
+    data = await aload_schedule()
+    subscribers = data.get('подписчики', {})
+    user_key = str(msg.from_user.id)
+    stop = subscribers.get(user_key)
+    if user_key in subscribers and (stop is None or stop[0] != info.id or abs(stop[1] - progress) >= 1):
+        await patch_schedule(('set', ('подписчики', user_key), [info.id, round(progress, 1)]), wait=False)
+    now = datetime.now()
+    
+    if dist_start < info.geometry.length / 2:
+        direction = info.directions[0]
+        times = get_schedule(direction, today)
+        text = f"""📍 Вы {info.place(info.start, 'где')} ({progress:.0f}%)
+🚌 До {info.place(info.end, 'род')}: {', '.join(times) or 'нет рейсов'}
 ⏰ Автобус через: {eta}"""
     else:
-        times = get_schedule("Медведица→Жирновск", today)
-        dist_to_end = 13.3 - dist_start
-        text = f"""📍 Вы около Медведицы ({progress:.0f}%)
-🚌 До Жирновска: {', '.join(times) or 'нет рейсов'}
+        direction = info.directions[1]
+        times = get_schedule(direction, today)
+        text = f"""📍 Вы около {info.place(info.end, 'род')} ({progress:.0f}%)
+🚌 До {info.place(info.start, 'род')}: {', '.join(times) or 'нет рейсов'}
 ⏰ Автобус через: {eta}"""
     
+    next_dep = timetable.next_departure(direction, today, now.hour * 60 + now.minute)
+    if next_dep is not None:
+        text += f"\n🕐 Ближайший рейс: {fmt_minutes(next_dep)}"
+    
+    await msg.answer(text)
+
+@dp.message(F.text == "🔔 Уведомления")
+async def toggle_notifications(msg: Message):
+    data = await aload_schedule()
+    user_key = str(msg.from_user.id)
+    
+    if user_key in data.get('подписчики', {}):
+        await patch_schedule(('delete', ('подписчики', user_key)))
+        text = "🔕 Уведомления отключены"
+    else:
+        await patch_schedule(('set', ('подписчики', user_key), None))
+        text = "🔔 Сообщу, когда автобус будет подъезжать.\n📍 Отправьте геолокацию — буду предупреждать о вашей остановке."
+    
     await msg.answer(text)
 
 @dp.message(F.text == '/driver_mode')
 async def driver_mode(msg: Message):
-    if msg.from_user.id != DRIVER_ID:
+    if msg.from_user.id not in registry.by_driver:
         await msg.answer("❌ Только для водителя.")
         return
     await msg.answer("🚍 GPS отправляйте скрепкой → Геопозиция → 1 час")
@@ -248,7 +508,7 @@ async def admin_panel(msg: Message):
         await msg.answer("❌ Нет доступа!")
         return
     
-    print(f"🔍 АДМИН {msg.from_user.id} зашёл в панель")
+    logging.info(f"🔍 АДМИН {msg.from_user.id} зашёл в панель")
     
     kb = ReplyKeyboardMarkup(keyboard=[
         [KeyboardButton(text="📅 Настроить расписание")],
@@ -260,47 +520,130 @@ async def admin_panel(msg: Message):
     
     await msg.answer("🔧 АДМИН-ПАНЕЛЬ", reply_markup=kb)
 
+async def admin_route(state: FSMContext):
+    # Маршрут, выбранный админом в меню расписания; по умолчанию — первый
+    route_id = (await state.get_data()).get('route')
+    return registry.routes.get(route_id) or next(iter(registry.routes.values()))
+
 @dp.message(F.text == "📅 Настроить расписание")
-async def admin_schedule_menu(msg: Message):
+async def admin_schedule_menu(msg: Message, state: FSMContext):
     if not is_admin(msg.from_user.id): return
     
-    data = load_schedule()
-    weekdays = ', '.join(data['базовое_расписание']['будни']['Жирновск→Медведица'])
-    saturday = ', '.join(data['базовое_расписание']['суббота']['Жирновск→Медведица'])
+    data = await aload_schedule()
+    info = await admin_route(state)
+    outbound = info.directions[0]
+    weekdays = ', '.join(data['базовое_расписание']['будни'].get(outbound, []))
+    saturday = ', '.join(data['базовое_расписание']['суббота'].get(outbound, []))
     
     kb = ReplyKeyboardMarkup(keyboard=[
         [KeyboardButton(text="📋 Будни"), KeyboardButton(text="📋 Суббота")],
+        [KeyboardButton(text="📤 Экспорт CSV")],
         [KeyboardButton(text="🔙 Назад")]
     ], resize_keyboard=True)
     
-    await msg.answer(f"""📅 ТЕКУЩЕЕ РАСПИСАНИЕ:
+    title = "📅 ТЕКУЩЕЕ РАСПИСАНИЕ:"
+    if len(registry.routes) > 1:
+        title = f"📅 ТЕКУЩЕЕ РАСПИСАНИЕ ({info.name}):"
+        kb.keyboard[-1:-1] = [[KeyboardButton(text=f"🛣️ {r.name}")] for r in registry.routes.values()]
+    
+    await msg.answer(f"""{title}
 Будни: {weekdays}
 Суббота: {saturday}
 
-Выберите что редактировать:""", reply_markup=kb)
+Выберите что редактировать:
+📥 Или пришлите файл расписания: CSV (day,direction,time), JSON или GTFS .zip
+(для GTFS у маршрута должен быть задан gtfs_route_id)""", reply_markup=kb)
+
+# 📦 Импорт и экспорт расписания файлом
+def routes_directions():
+    return {info.id: info.directions for info in registry.routes.values()}
+
+def gtfs_routes():
+    # route_id перевозчика → (туда, обратно); без 'gtfs_route_id' маршрут в GTFS не сопоставлен
+    return {info.gtfs_route_id: info.directions for info in registry.routes.values() if info.gtfs_route_id}
+
+@dp.message(F.text == "📤 Экспорт CSV")
+async def export_schedule(msg: Message):
+    if not is_admin(msg.from_user.id): return
+    
+    data = await aload_schedule()
+    content = await asyncio.to_thread(
+        export_timetable, data['базовое_расписание'], 'csv', export_routes(routes_directions(), gtfs_routes()),
+    )
+    await msg.answer_document(BufferedInputFile(content, 'schedule.csv'), caption="📤 Базовое расписание")
+
+@dp.message(F.document)
+async def import_schedule(msg: Message):
+    if not is_admin(msg.from_user.id): return
+    
+    try:
+        fmt = detect_format(msg.document.file_name or '')
+    except ValueError as e:
+        await msg.answer(f"❌ {e}")
+        return
+    if (msg.document.file_size or 0) > MAX_IMPORT_BYTES:
+        await msg.answer(f"❌ Файл больше {MAX_IMPORT_BYTES // 2 ** 20} МБ")
+        return
+    
+    buffer = await bot.download(msg.document)
+    try:
+        result = await asyncio.to_thread(import_timetable, buffer.getvalue(), fmt, gtfs_routes(), set(registry.by_direction))
+    except (ValueError, KeyError, zipfile.BadZipFile) as e:
+        await msg.answer(f"❌ Не удалось прочитать файл: {e}")
+        return
+    if not result.rows:
+        await msg.answer(f"❌ Ничего не загружено, пропущено строк: {result.skipped}\n" + "\n".join(result.errors[:5]))
+        return
+    
+    await patch_schedule(*(
+        ('set', ('базовое_расписание', day, direction), times)
+        for day, by_direction in result.base.items()
+        for direction, times in by_direction.items()
+    ))
+    text = f"✅ Загружено рейсов: {result.rows}"
+    for day, by_direction in result.base.items():
+        text += f"\n{day}: " + ", ".join(f"{direction} — {len(times)}" for direction, times in by_direction.items())
+    if result.skipped:
+        text += f"\n⚠️ Пропущено строк: {result.skipped}\n" + "\n".join(result.errors[:5])
+    await msg.answer(text)
+
+@dp.message(F.text.startswith("🛣️ "))
+async def select_admin_route(msg: Message, state: FSMContext):
+    if not is_admin(msg.from_user.id): return
+    
+    name = msg.text.removeprefix("🛣️ ")
+    for info in registry.routes.values():
+        if info.name == name:
+            await state.update_data(route=info.id)
+            break
+    await admin_schedule_menu(msg, state)
 
 @dp.message(F.text == "📋 Будни")
 async def edit_weekdays(msg: Message, state: FSMContext):
     if not is_admin(msg.from_user.id): return
     await state.set_state(AdminStates.waiting_weekdays)
+    await state.update_data(fingerprint=await schedule_store.fingerprint('базовое_расписание'))
     await msg.answer("📝 Введите время будней через запятую (06:20,07:20) или 'отмена':")
     
 @dp.message(AdminStates.waiting_weekdays)
 async def save_weekdays(msg: Message, state: FSMContext):
     times_input = msg.text.strip().lower()
-    data = load_schedule()
-    
-    if times_input == 'отмена':
-        times = []
-    else:
-        times = [t.strip() for t in times_input.split(',')]
-        times = [t for t in times if len(t) == 5 and ':' in t]
+    info = await admin_route(state)
     
-    data['базовое_расписание']['будни']['Жирновск→Медведица'] = times
-    data['базовое_расписание']['будни']['Медведица→Жирновск'] = [f"{t[:3]}30" for t in times]
-    save_schedule(data)
+    times, bad = ([], []) if times_input == 'отмена' else parse_time_list(times_input)
+    if bad:
+        await msg.answer(f"⚠️ Пропущено: {', '.join(bad)}")
     
-    await msg.answer(f"✅ Будни: {', '.join(times) or 'отменено'}")
+    outbound, back = info.directions
+    try:
+        await patch_schedule(
+            ('set', ('базовое_расписание', 'будни', outbound), times),
+            ('set', ('базовое_расписание', 'будни', back), info.derive_return(times)),
+            expected=(await state.get_data()).get('fingerprint'),
+        )
+        await msg.answer(f"✅ Будни: {', '.join(times) or 'отменено'}")
+    except VersionConflict:
+        await msg.answer("⚠️ Расписание изменили, пока вы вводили. Откройте правку заново.")
     await state.clear()
     await admin_panel(msg)
 
@@ -308,24 +651,28 @@ async def save_weekdays(msg: Message, state: FSMContext):
 async def edit_saturday(msg: Message, state: FSMContext):
     if not is_admin(msg.from_user.id): return
     await state.set_state(AdminStates.waiting_saturday)
+    await state.update_data(fingerprint=await schedule_store.fingerprint('базовое_расписание'))
     await msg.answer("📝 Введите время субботы через запятую или 'отмена':")
     
 @dp.message(AdminStates.waiting_saturday)
 async def save_saturday(msg: Message, state: FSMContext):
     times_input = msg.text.strip().lower()
-    data = load_schedule()
-    
-    if times_input == 'отмена':
-        times = []
-    else:
-        times = [t.strip() for t in times_input.split(',')]
-        times = [t for t in times if len(t) == 5 and ':' in t]
+    info = await admin_route(state)
     
-    data['базовое_расписание']['суббота']['Жирновск→Медведица'] = times
-    data['базовое_расписание']['суббота']['Медведица→Жирновск'] = [f"{t[:3]}30" for t in times]
-    save_schedule(data)
+    times, bad = ([], []) if times_input == 'отмена' else parse_time_list(times_input)
+    if bad:
+        await msg.answer(f"⚠️ Пропущено: {', '.join(bad)}")
     
-    await msg.answer(f"✅ Суббота: {', '.join(times) or 'отменено'}")
+    outbound, back = info.directions
+    try:
+        await patch_schedule(
+            ('set', ('базовое_расписание', 'суббота', outbound), times),
+            ('set', ('базовое_расписание', 'суббота', back), info.derive_return(times)),
+            expected=(await state.get_data()).get('fingerprint'),
+        )
+        await msg.answer(f"✅ Суббота: {', '.join(times) or 'отменено'}")
+    except VersionConflict:
+        await msg.answer("⚠️ Расписание изменили, пока вы вводили. Откройте правку заново.")
     await state.clear()
     await admin_panel(msg)
 
@@ -334,57 +681,125 @@ async def cancel_reys(msg: Message):
     if not is_admin(msg.from_user.id): return
     
     today = datetime.now().strftime('%Y-%m-%d')
-    to_med = get_schedule("Жирновск→Медведица", today)
-    back = get_schedule("Медведица→Жирновск", today)
     
-    text = f"🛑 Рейсы сегодня ({today}):\n\nЖирновск→Медведица:\n"
-    for t in to_med:
-        text += f"• {t}\n"
-    text += f"\nМедведица→Жирновск:\n"
-    for t in back:
-        text += f"• {t}\n"
+    text = f"🛑 Рейсы сегодня ({today}):\n"
+    for direction in registry.by_direction:
+        text += f"\n{direction}:\n"
+        for t in get_schedule(direction, today):
+            text += f"• {t}\n"
     
-    kb = ReplyKeyboardMarkup(keyboard=[
-        [KeyboardButton(text="🛑 Отменить Жирновск→Медведица")],
-        [KeyboardButton(text="🛑 Отменить Медведица→Жирновск")],
-        [KeyboardButton(text="🔙 Назад")]
-    ], resize_keyboard=True)
+    kb = ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text="✂️ Отдельные рейсы")]]
+        + [[KeyboardButton(text=f"🛑 Отменить {direction}")] for direction in registry.by_direction]
+        + [[KeyboardButton(text="🔙 Назад")]],
+        resize_keyboard=True,
+    )
     
     await msg.answer(text, reply_markup=kb)
 
-@dp.message(F.text == "🛑 Отменить Жирновск→Медведица")
-async def cancel_to_medveditsa(msg: Message):
+@dp.message(F.text.startswith("🛑 Отменить "))
+async def cancel_direction(msg: Message):
     if not is_admin(msg.from_user.id): return
     
+    direction = msg.text.removeprefix("🛑 Отменить ")
+    if direction not in registry.by_direction:
+        await msg.answer("❌ Нет такого направления")
+        return
+    
     today = datetime.now().strftime('%Y-%m-%d')
-    data = load_schedule()
-    if today not in data['изменения']:
-        data['изменения'][today] = {}
-    data['изменения'][today]["Жирновск→Медведица"] = []
-    save_schedule(data)
+    await patch_timetable(
+        ('set', ('изменения', today, direction), []),
+        ('delete', ('отклонения', today, direction)),
+    )
     
-    await msg.answer("✅ Все рейсы Жирновск→Медведица отменены!")
+    await msg.answer(f"✅ Все рейсы {direction} отменены!")
     await admin_panel(msg)
 
-@dp.message(F.text == "🛑 Отменить Медведица→Жирновск")
-async def cancel_back(msg: Message):
+def parse_trip_change(line, today):
+    # '-08:00 Жирновск→Медведица 2026-10-19..2026-10-25' → ('-', '08:00', период, направление)
+    # Знак: - снять рейс, + добавить; без даты — на сегодня
+    parts = line.split()
+    if len(parts) < 2 or parts[0][:1] not in '+-':
+        raise ValueError(line)
+    sign, time_str = parts[0][0], datetime.strptime(parts[0][1:], '%H:%M').strftime('%H:%M')
+    period = today
+    if '-' in parts[-1] and len(parts) > 2:
+        period = parts.pop()
+        start, _, end = period.partition('..')
+        if datetime.strptime(start, '%Y-%m-%d') > datetime.strptime(end or start, '%Y-%m-%d'):
+            raise ValueError(line)
+        if end == start:
+            period = start
+    direction = ' '.join(parts[1:])
+    if direction not in registry.by_direction:
+        raise ValueError(line)
+    
+    return sign, time_str, period, direction
+
+def shift_day(date_str, days):
+    return (datetime.strptime(date_str, '%Y-%m-%d') + timedelta(days=days)).strftime('%Y-%m-%d')
+
+def trip_change_ops(data, sign, time_str, period, direction):
+    # Новая правка главнее прежних: обратный знак в пересекающихся периодах снимаем
+    # только на общих днях, а замены дня целиком правим в самом списке рейсов
+    start, end = parse_period(period)
+    opposite = '+' if sign == '-' else '-'
+    ops = [
+        ('remove', ('отклонения', period, direction, opposite), time_str),
+        ('add', ('отклонения', period, direction, sign), time_str),
+    ]
+    for other, directions in data.get('отклонения', {}).items():
+        lo, hi = parse_period(other)
+        if other == period or hi < start or lo > end:
+            continue
+        if time_str not in directions.get(direction, {}).get(opposite, ()):
+            continue
+        ops.append(('remove', ('отклонения', other, direction, opposite), time_str))
+        if lo < start:
+            ops.append(('add', ('отклонения', fmt_period(lo, shift_day(start, -1)), direction, opposite), time_str))
+        if hi > end:
+            ops.append(('add', ('отклонения', fmt_period(shift_day(end, 1), hi), direction, opposite), time_str))
+    for date_str, changes in data.get('изменения', {}).items():
+        if start <= date_str <= end and direction in changes:
+            ops.append(('add' if sign == '+' else 'remove', ('изменения', date_str, direction), time_str))
+    return ops
+
+@dp.message(F.text == "✂️ Отдельные рейсы")
+async def edit_trips(msg: Message, state: FSMContext):
     if not is_admin(msg.from_user.id): return
-    
-    today = datetime.now().strftime('%Y-%m-%d')
-    data = load_schedule()
-    if today not in data['изменения']:
-        data['изменения'][today] = {}
-    data['изменения'][today]["Медведица→Жирновск"] = []
-    save_schedule(data)
-    
-    await msg.answer("✅ Все рейсы Медведица→Жирновск отменены!")
+    await state.set_state(AdminStates.waiting_trip_changes)
+    await msg.answer(
+        "✂️ По строке на рейс: знак, время, направление и дата или период.\n"
+        "-08:00 Жирновск→Медведица 2026-10-19..2026-10-25 — снять\n"
+        "+12:00 Медведица→Жирновск — добавить сегодня\n"
+        "или 'отмена':"
+    )
+
+@dp.message(AdminStates.waiting_trip_changes)
+async def save_trips(msg: Message, state: FSMContext):
+    text = msg.text.strip()
+    if text.lower() != 'отмена':
+        today = datetime.now().strftime('%Y-%m-%d')
+        changes = []
+        for line in filter(str.strip, text.splitlines()):
+            try:
+                changes.append(parse_trip_change(line, today))
+            except ValueError:
+                await msg.answer(f"❌ Не понял строку: {line}")
+                return
+        # По строке за раз: следующая строка видит результат предыдущей
+        for change in changes:
+            data = await aload_schedule()
+            await patch_timetable(*trip_change_ops(data, *change))
+        await msg.answer(f"✅ Изменено рейсов: {len(changes)}")
+    await state.clear()
     await admin_panel(msg)
 
 @dp.message(F.text == "🎉 Праздники")
 async def holidays_menu(msg: Message):
     if not is_admin(msg.from_user.id): return
     
-    data = load_schedule()
+    data = await aload_schedule()
     holidays = data.get('праздники', [])
     
     kb = ReplyKeyboardMarkup(keyboard=[
@@ -407,10 +822,7 @@ async def save_holiday(msg: Message, state: FSMContext):
     date_str = msg.text.strip()
     try:
         datetime.strptime(date_str, '%Y-%m-%d')
-        data = load_schedule()
-        if date_str not in data['праздники']:
-            data['праздники'].append(date_str)
-            save_schedule(data)
+        if await patch_schedule(('add', ('праздники',), date_str)):
             await msg.answer(f"✅ {date_str} добавлен в праздники!")
         else:
             await msg.answer("❌ Уже праздник!")
@@ -423,7 +835,7 @@ async def save_holiday(msg: Message, state: FSMContext):
 async def remove_holiday_menu(msg: Message):
     if not is_admin(msg.from_user.id): return
     
-    data = load_schedule()
+    data = await aload_schedule()
     holidays = data.get('праздники', [])
     
     if not holidays:
@@ -438,9 +850,7 @@ async def delete_holiday(msg: Message):
     if not is_admin(msg.from_user.id): return
     
     date = msg.text[2:].strip()
-    data = load_schedule()
-    data['праздники'] = [h for h in data['праздники'] if h != date]
-    save_schedule(data)
+    await patch_schedule(('remove', ('праздники',), date))
     await msg.answer(f"✅ {date} удалён!")
     await holidays_menu(msg)
 
@@ -448,7 +858,7 @@ async def delete_holiday(msg: Message):
 async def notify_chat_menu(msg: Message, state: FSMContext):
     if not is_admin(msg.from_user.id): return
     
-    data = load_schedule()
+    data = await aload_schedule()
     chat_id = data.get('notify_chat')
     text = f"📢 Чат уведомлений: {chat_id or 'НЕ УСТАНОВЛЕН'}\n\nОтправьте ID чата:"
     
@@ -463,16 +873,14 @@ async def notify_chat_menu(msg: Message, state: FSMContext):
 @dp.message(AdminStates.waiting_notify_chat)
 async def save_notify_chat(msg: Message, state: FSMContext):
     text = msg.text.strip()
-    data = load_schedule()
     
     if text == "❌ Отключить":
-        data['notify_chat'] = None
+        await patch_schedule(('set', ('notify_chat',), None))
         await msg.answer("✅ Уведомления отключены")
     else:
-        data['notify_chat'] = int(text)
+        await patch_schedule(('set', ('notify_chat',), int(text)))
         await msg.answer(f"✅ Чат {text} установлен")
     
-    save_schedule(data)
     await state.clear()
     await admin_panel(msg)
 
@@ -480,17 +888,34 @@ async def save_notify_chat(msg: Message, state: FSMContext):
 async def show_stats(msg: Message):
     if not is_admin(msg.from_user.id): return
     
-    data = load_schedule()
+    data = await aload_schedule()
     today = datetime.now().strftime('%Y-%m-%d')
+    gps_active = any(v.positions.last() for v in registry.vehicles.values())
+    weekday_trips = sum(
+        len(data['базовое_расписание']['будни'].get(info.directions[0], [])) for info in registry.routes.values()
+    )
     
     text = f"""📊 СТАТИСТИКА:
 
 📅 Сегодня: {today}
-📍 GPS активен: {'✅' if data.get('автобус_позиция') else '❌'}
+📍 GPS активен: {'✅' if gps_active else '❌'}
+🛣️ Маршрутов: {len(registry.routes)}, автобусов: {len(registry.vehicles)}
 🎉 Праздников: {len(data.get('праздники', []))}
 📢 Уведомления: {data.get('notify_chat', 'откл')}
+🔔 Подписчиков: {len(data.get('подписчики', {}))}
 
-Расписание будни: {len(data['базовое_расписание']['будни']['Жирновск→Медведица'])} рейсов"""
+Расписание будни: {weekday_trips} рейсов"""
+    
+    # Пунктуальность по пройденным рейсам
+    early, late = ON_TIME_MIN
+    lines = []
+    for info in registry.routes.values():
+        stats = trip_history.stats(info.id)
+        for kind in ('будни', 'суббота'):
+            good, total = stats.on_time(kind)
+            if total:
+                lines.append(f"⏱️ {info.name}, {kind}: вовремя {good * 100 // total}% из {total} рейсов")
+    text += f"\n\n🕐 Вовремя — от {early:+d} до {late:+d} мин к расписанию\n" + ("\n".join(lines) or "⏱️ Пройденных рейсов пока нет")
     
     await msg.answer(text)
 
@@ -499,12 +924,69 @@ async def show_stats(msg: Message):
 async def back_to_main(msg: Message):
     await start_handler(msg)
 
+async def run_polling():
+    await bot.delete_webhook()
+    await dp.start_polling(bot)
+
+async def run_webhook():
+    # Без секрета любой, кто достучится до пути, подделает апдейт от админа или водителя
+    if not WEBHOOK_SECRET:
+        raise SystemExit("❌ Для BOT_MODE=webhook задайте WEBHOOK_SECRET (тот же, что передан Telegram в setWebhook)")
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+        print(f"🌐 Webhook: {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
 async def main():
+    # Ограниченный пул для всей файловой работы (asyncio.to_thread идёт туда же)
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(IO_WORKERS, thread_name_prefix='io'))
     init_schedule()
+    init_registry()
     print("🚀 Бот автобуса запущен!")
     print(f"👨‍💼 Админы: {ADMIN_IDS}")
-    print(f"🚗 Водитель: {DRIVER_ID}")
-    await dp.start_polling(bot)
+    print(f"🚗 Водители: {list(registry.by_driver)}")
+    schedule_store.start()
+    await patch_timetable()
+    notifier_task = asyncio.create_task(notifier.run())
+    trips_task = asyncio.create_task(trip_history.run())
+    metrics_runner = await start_metrics()
+    try:
+        if BOT_MODE == 'webhook':
+            try:
+                await run_webhook()
+            except (OSError, TelegramAPIError) as e:
+                # Не удалось поднять сервер — продолжаем на long polling
+                logging.error(f"Webhook недоступен ({e}), переключаюсь на polling")
+                await run_polling()
+        else:
+            await run_polling()
+    finally:
+        notifier_task.cancel()
+        trips_task.cancel()
+        await asyncio.gather(trips_task, return_exceptions=True)
+        try:
+            await trip_history.update()  # дописать рейсы, пройденные после последнего пересчёта
+        except Exception:
+            # Не мешаем сохранить расписание и GPS ниже
+            logging.exception("Не удалось записать рейсы при остановке")
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await schedule_store.close()
+        registry.close()
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -0,0 +1,102 @@
+import json
+import time
+import asyncio
+import sqlite3
+import threading
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+PURGE_INTERVAL = 600  # сек между чистками просроченных состояний
+
+
+# 🧠 FSM в SQLite: переживает перезапуск, общий файл для нескольких процессов
+class SQLiteStorage(BaseStorage):
+    def __init__(self, path, ttl=None):
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._lock = threading.Lock()
+        self._next_purge = 0
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS fsm (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated REAL NOT NULL
+        )''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS fsm_updated ON fsm (updated)')
+
+    def _alive_since(self):
+        return time.time() - self.ttl if self.ttl else 0
+
+    def _purge(self):
+        now = time.time()
+        if self.ttl and now >= self._next_purge:
+            self._db.execute('DELETE FROM fsm WHERE updated < ?', (now - self.ttl,))
+            self._next_purge = now + PURGE_INTERVAL
+
+    def _write(self, key, column, value):
+        with self._lock:
+            self._purge()
+            self._db.execute(
+                f'INSERT INTO fsm (key, {column}, updated) VALUES (?, ?, ?) '
+                f'ON CONFLICT(key) DO UPDATE SET {column} = excluded.{column}, updated = excluded.updated',
+                (key, value, time.time()),
+            )
+
+    def _read(self, key, column):
+        with self._lock:
+            row = self._db.execute(
+                f'SELECT {column} FROM fsm WHERE key = ? AND updated >= ?',
+                (key, self._alive_since()),
+            ).fetchone()
+        return row[0] if row else None
+
+    def _count_states(self):
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT state, COUNT(*) FROM fsm WHERE state IS NOT NULL AND updated >= ? GROUP BY state',
+                (self._alive_since(),),
+            ).fetchall()
+        return dict(rows)
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        state = state.state if isinstance(state, State) else state
+        await asyncio.to_thread(self._write, self.key_builder.build(key), 'state', state)
+
+    async def get_state(self, key: StorageKey):
+        return await asyncio.to_thread(self._read, self.key_builder.build(key), 'state')
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        payload = json.dumps(dict(data), ensure_ascii=False)
+        await asyncio.to_thread(self._write, self.key_builder.build(key), 'data', payload)
+
+    async def get_data(self, key: StorageKey):
+        payload = await asyncio.to_thread(self._read, self.key_builder.build(key), 'data')
+        return json.loads(payload) if payload else {}
+
+    async def count_states(self):
+        return await asyncio.to_thread(self._count_states)
+
+    async def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+def make_fsm_storage(kind='memory', sqlite_path='fsm.sqlite3', redis_url=None, ttl=None):
+    if kind == 'sqlite':
+        return SQLiteStorage(sqlite_path, ttl=ttl)
+    if kind == 'redis':
+        # Подходит любой Redis-совместимый сервер (KeyDB, Dragonfly, локальная заглушка)
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(
+            redis_url or 'redis://localhost:6379/0',
+            key_builder=DefaultKeyBuilder(with_bot_id=True, with_destiny=True),
+            state_ttl=ttl,
+            data_ttl=ttl,
+        )
+    if kind == 'memory':
+        return MemoryStorage()
+    raise ValueError(f"Неизвестное хранилище FSM: {kind}")
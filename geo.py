@@ -0,0 +1,27 @@
+from math import radians, sin, cos, sqrt, atan2
+
+try:
+    import numpy as np
+except ImportError:  # без numpy пакетные функции считают в цикле
+    np = None
+
+EARTH_KM = 6371
+
+
+# 📏 Расстояние по дуге большого круга, км
+def haversine(lat1, lon1, lat2, lon2):
+    dlat = radians(lat2 - lat1)
+    dlon = radians(lon2 - lon1)
+    a = sin(dlat/2)**2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon/2)**2
+    return 2 * EARTH_KM * atan2(sqrt(a), sqrt(1-a))
+
+
+# 📏 То же для массивов (с broadcasting): N пассажиров × одна отметка и т.п.
+def haversine_many(lat1, lon1, lat2, lon2):
+    if np is None:
+        n = max(len(x) for x in (lat1, lon1, lat2, lon2) if hasattr(x, '__len__'))
+        pick = lambda x, i: x[i] if hasattr(x, '__len__') else x
+        return [haversine(pick(lat1, i), pick(lon1, i), pick(lat2, i), pick(lon2, i)) for i in range(n)]
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=float)) for x in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_KM * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
@@ -0,0 +1,79 @@
+import os
+import mmap
+import struct
+from collections import namedtuple
+from pathlib import Path
+
+# 📡 Отметки GPS водителя: кольцевой буфер в mmap-файле, отдельно от schedule.json
+Fix = namedtuple('Fix', 'lat lon time progress')
+
+MAGIC = b'AVTOGPS1'
+HEADER = struct.Struct('<8sIIQ')  # магия, ёмкость, кол-во, порядковый номер следующей записи
+RECORD = struct.Struct('<dddd')   # lat, lon, unix-время, прогресс %
+
+
+class PositionStore:
+    def __init__(self, path: Path, capacity: int = 256):
+        self.path = Path(path)
+        self.capacity = capacity
+        self._mm = None
+        self._count = 0
+        self._seq = 0
+        self._last = None
+
+    def _open(self):
+        size = HEADER.size + RECORD.size * self.capacity
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self._mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        magic, capacity, count, seq = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or capacity != self.capacity:
+            # Новый файл или другая ёмкость — начинаем историю заново
+            count, seq = 0, 0
+            HEADER.pack_into(self._mm, 0, MAGIC, self.capacity, 0, 0)
+        self._count, self._seq = count, seq
+        if count:
+            self._last = self._read((seq - 1) % self.capacity)
+
+    def _ensure(self):
+        if self._mm is None:
+            self._open()
+
+    def _read(self, slot):
+        return Fix(*RECORD.unpack_from(self._mm, HEADER.size + slot * RECORD.size))
+
+    @property
+    def seq(self):
+        self._ensure()
+        return self._seq
+
+    def push(self, lat, lon, ts, progress):
+        self._ensure()
+        slot = self._seq % self.capacity
+        RECORD.pack_into(self._mm, HEADER.size + slot * RECORD.size, lat, lon, ts, progress)
+        self._seq += 1
+        self._count = min(self._count + 1, self.capacity)
+        HEADER.pack_into(self._mm, 0, MAGIC, self.capacity, self._count, self._seq)
+        self._last = Fix(lat, lon, ts, progress)
+        return self._last
+
+    def last(self):
+        self._ensure()
+        return self._last
+
+    def recent(self, n=None):
+        self._ensure()
+        n = self._count if n is None else min(n, self._count)
+        return [self._read((self._seq - i) % self.capacity) for i in range(n, 0, -1)]
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.flush()
+            self._mm.close()
+            self._mm = None
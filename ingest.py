@@ -0,0 +1,111 @@
+from math import radians, degrees, cos, sqrt, atan2
+from collections import namedtuple
+
+from geo import EARTH_KM
+from route import MAX_SPEED_KMH
+
+# 📡 Приём отметок водителя: отсев повторов и опозданий, сглаживание, скорость и курс
+# Sample совместим с gps.Fix (lat lon time progress) + скорость км/ч и курс в градусах от севера
+Sample = namedtuple('Sample', 'lat lon time progress speed heading')
+
+ALPHA, BETA = 0.5, 0.1    # усиления альфа-бета фильтра (установившийся Калман) по положению и скорости
+REF_ACCURACY_M = 25       # при такой точности GPS положение сглаживается с ALPHA
+MAX_REJECTS = 3           # столько скачков подряд — значит, автобус правда там, начинаем заново
+MAX_GAP_SEC = 120         # после такого перерыва (стоянка, нет связи) скорость устарела — трек заново
+
+
+# 📢 Канал в памяти: последняя отметка каждого автобуса и подписчики
+class FixChannel:
+    def __init__(self):
+        self._latest = {}
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        # callback(автобус, Sample) — синхронный, вызывается сразу при публикации
+        self._subscribers.append(callback)
+
+    def publish(self, vehicle, sample: Sample):
+        self._latest[vehicle.id] = sample
+        for callback in self._subscribers:
+            callback(vehicle, sample)
+
+    def latest(self, vehicle_id):
+        return self._latest.get(vehicle_id)
+
+
+class _Track:
+    def __init__(self, lat, lon, ts):
+        self.lat0, self.lon0 = lat, lon
+        self._kx = radians(1) * EARTH_KM * cos(radians(lat))
+        self._ky = radians(1) * EARTH_KM
+        self.x = self.y = 0.0
+        self.raw = (0.0, 0.0)     # последняя принятая отметка как есть, без сглаживания
+        self.vx = self.vy = 0.0   # км/с
+        self.time = ts
+        self.rejects = 0
+        self.started = False      # скорость ещё не известна — вторая отметка задаёт её напрямую
+
+    def to_xy(self, lat, lon):
+        return (lon - self.lon0) * self._kx, (lat - self.lat0) * self._ky
+
+    def to_latlon(self, x, y):
+        return self.lat0 + y / self._ky, self.lon0 + x / self._kx
+
+
+class FixIngest:
+    def __init__(self, channel: FixChannel):
+        self.channel = channel
+        self._tracks = {}
+
+    def accept(self, vehicle, lat, lon, ts, accuracy_m=None):
+        # → Sample или None, если отметка старая, повторная или невозможный скачок
+        track = self._tracks.get(vehicle.id)
+        if track is None:
+            last = vehicle.positions.last()
+            if last is not None and ts <= last.time:
+                return None
+            track = self._tracks[vehicle.id] = _Track(lat, lon, ts)
+            return self._publish(vehicle, track, lat, lon, ts)
+
+        dt = ts - track.time
+        if dt <= 0:
+            return None  # опоздавшая или повторная отметка
+
+        # Скачок проверяем по сырым отметкам: прогноз фильтра после долгой паузы сам может уехать
+        zx, zy = track.to_xy(lat, lon)
+        jump = sqrt((zx - track.raw[0]) ** 2 + (zy - track.raw[1]) ** 2) / dt * 3600 > MAX_SPEED_KMH
+        if jump:
+            track.rejects += 1
+            if track.rejects < MAX_REJECTS:
+                return None
+        if jump or dt > MAX_GAP_SEC:
+            track = self._tracks[vehicle.id] = _Track(lat, lon, ts)
+            return self._publish(vehicle, track, lat, lon, ts)
+
+        px, py = track.x + track.vx * dt, track.y + track.vy * dt
+        rx, ry = zx - px, zy - py
+        if not track.started:
+            track.vx, track.vy = (zx - track.x) / dt, (zy - track.y) / dt
+            track.x, track.y = zx, zy
+            track.started = True
+        else:
+            alpha = ALPHA
+            if accuracy_m:
+                alpha = min(0.9, max(0.1, ALPHA * REF_ACCURACY_M / accuracy_m))
+            track.x, track.y = px + alpha * rx, py + alpha * ry
+            track.vx += BETA * rx / dt
+            track.vy += BETA * ry / dt
+        track.raw = zx, zy
+        track.time = ts
+        track.rejects = 0
+        return self._publish(vehicle, track, *track.to_latlon(track.x, track.y), ts)
+
+    def _publish(self, vehicle, track, lat, lon, ts):
+        speed = sqrt(track.vx ** 2 + track.vy ** 2) * 3600
+        heading = (degrees(atan2(track.vx, track.vy)) + 360) % 360
+        geometry = vehicle.route.geometry
+        progress = geometry.project(lat, lon)[0] / geometry.length * 100
+        fix = vehicle.positions.push(lat, lon, ts, progress)
+        sample = Sample(fix.lat, fix.lon, fix.time, fix.progress, round(speed, 1), round(heading))
+        self.channel.publish(vehicle, sample)
+        return sample
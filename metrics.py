@@ -0,0 +1,171 @@
+import time
+import inspect
+from bisect import bisect_left
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.fsm.storage.base import BaseStorage
+
+# Границы корзин гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+# 🔢 Счётчик: только растёт
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    async def render(self):
+        return [f'{self.name}{_labels(self.labelnames, k)} {v}' for k, v in self.values.items()]
+
+
+# 📊 Гистограмма: наблюдение — один bisect и пара сложений
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self.buckets = tuple(buckets)
+        self.values = {}  # метки → [счётчики по корзинам..., сумма, количество]
+
+    def observe(self, value, *labels):
+        row = self.values.get(labels)
+        if row is None:
+            row = self.values[labels] = [0] * (len(self.buckets) + 3)
+        row[bisect_left(self.buckets, value)] += 1
+        row[-2] += value
+        row[-1] += 1
+
+    async def render(self):
+        lines = []
+        for labels, row in self.values.items():
+            total = 0
+            for bound, n in zip((*self.buckets, '+Inf'), row):
+                total += n
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, labels, le)} {total}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, labels)} {row[-2]}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, labels)} {row[-1]}')
+        return lines
+
+
+# 🌡️ Показатель, который считается в момент запроса /metrics
+# collect() → {метки: значение}, может быть корутиной
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help, labelnames=(), collect=None):
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self.collect = collect
+
+    async def render(self):
+        values = self.collect()
+        if inspect.isawaitable(values):
+            values = await values
+        return [f'{self.name}{_labels(self.labelnames, k)} {v}' for k, v in values.items()]
+
+
+# 📈 Набор метрик и текстовый формат Prometheus
+class Metrics:
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, labelnames=(), collect=None):
+        return self._add(Gauge(name, help, labelnames, collect))
+
+    async def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(await metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def app(self, path='/metrics'):
+        async def handle(request):
+            return web.Response(text=await self.render(), content_type='text/plain', charset='utf-8')
+
+        app = web.Application()
+        app.router.add_get(path, handle)
+        return app
+
+
+# ⏱️ Внутренняя мидлварь: время выбранного хендлера
+class HandlerTimingMiddleware(BaseMiddleware):
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    async def __call__(self, handler, event, data):
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            handler_obj = data.get('handler')
+            name = handler_obj.callback.__name__ if handler_obj else 'unknown'
+            self.histogram.observe(time.perf_counter() - start, name)
+
+
+# 📥 Внешняя мидлварь на update: поток апдейтов по типам
+class UpdateCounterMiddleware(BaseMiddleware):
+    def __init__(self, counter: Counter):
+        self.counter = counter
+
+    async def __call__(self, handler, event, data):
+        self.counter.inc(event.event_type)
+        return await handler(event, data)
+
+
+# 🗃️ Обёртка над хранилищем FSM: время каждого обращения
+class TimedStorage(BaseStorage):
+    def __init__(self, storage: BaseStorage, histogram: Histogram):
+        self.storage = storage
+        self.histogram = histogram
+
+    async def _timed(self, op, call):
+        start = time.perf_counter()
+        try:
+            return await call
+        finally:
+            self.histogram.observe(time.perf_counter() - start, 'fsm', op)
+
+    async def set_state(self, key, state=None):
+        return await self._timed('set_state', self.storage.set_state(key, state))
+
+    async def get_state(self, key):
+        return await self._timed('get_state', self.storage.get_state(key))
+
+    async def set_data(self, key, data):
+        return await self._timed('set_data', self.storage.set_data(key, data))
+
+    async def get_data(self, key):
+        return await self._timed('get_data', self.storage.get_data(key))
+
+    async def close(self):
+        await self.storage.close()
+
+    def __getattr__(self, name):
+        # count_states, create_isolation и прочее — как у исходного хранилища
+        return getattr(self.storage, name)
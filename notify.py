@@ -0,0 +1,154 @@
+import time
+import asyncio
+import logging
+
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter, TelegramBadRequest
+
+log = logging.getLogger(__name__)
+
+# Лимиты Telegram: ~30 сообщений/с всего, 1/с в личку, 20/мин в группу
+GLOBAL_RATE = 30
+PRIVATE_INTERVAL = 1.0
+GROUP_INTERVAL = 3.0
+
+
+# 🪣 Ведро токенов
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self) -> bool:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def take(self):
+        while not self.try_take():
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# 🚦 Общий лимит отправки + интервал на каждый чат
+# rate=0 — без общего лимита (например, против фейкового Bot API)
+class SendLimiter:
+    def __init__(self, rate=GLOBAL_RATE, private_interval=PRIVATE_INTERVAL):
+        self.bucket = TokenBucket(rate) if rate else None
+        self.private_interval = private_interval
+        self._next_slot = {}
+
+    async def wait(self, chat_id: int):
+        interval = GROUP_INTERVAL if chat_id < 0 else self.private_interval
+        if interval:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(chat_id, 0))
+            self._next_slot[chat_id] = slot + interval
+            if slot > now:
+                await asyncio.sleep(slot - now)
+        if self.bucket is not None:
+            await self.bucket.take()
+        if len(self._next_slot) > 10_000:
+            now = time.monotonic()
+            self._next_slot = {c: t for c, t in self._next_slot.items() if t > now}
+
+
+# 🔔 Уведомления «автобус подъезжает» по отметкам водителей
+class ArrivalNotifier:
+    def __init__(self, bot, load_schedule, limiter: SendLimiter = None, approach_km: float = 2.0):
+        self.bot = bot
+        self.load_schedule = load_schedule
+        self.limiter = limiter
+        self.approach_km = approach_km
+        self._latest = {}
+        self._wakeup = asyncio.Event()
+        self._trips = {}  # id автобуса → [прошлый прогресс, направление, кого уже уведомили]
+
+    def feed(self, vehicle, fix):
+        # Важна только последняя отметка автобуса: если не успели обработать — перезаписываем
+        self._latest[vehicle] = fix
+        self._wakeup.set()
+
+    async def run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            pending, self._latest = self._latest, {}
+            for vehicle, fix in pending.items():
+                try:
+                    await self._process(vehicle, fix)
+                except Exception:
+                    log.exception("Ошибка рассылки уведомлений")
+
+    def _targets(self, data, route, direction):
+        # (чат, прогресс остановки %, название); None — конечная по направлению
+        end_name = route.place(route.end if direction > 0 else route.start, 'дат')
+        if data.get('notify_chat'):
+            yield data['notify_chat'], None, end_name
+        for chat_id, stop in data.get('подписчики', {}).items():
+            if stop is None:
+                yield int(chat_id), None, end_name
+            elif stop[0] == route.id:
+                yield int(chat_id), stop[1], 'вашей остановке'
+
+    async def _process(self, vehicle, fix):
+        # [опорный прогресс, направление, уведомлённые]: опора сдвигается, только когда автобус
+        # отъехал от неё на 0.5% — иначе частые близкие отметки живой геопозиции не дают направления
+        trip = self._trips.setdefault(vehicle.id, [fix.progress, 0, set()])
+        moved = fix.progress - trip[0]
+        if abs(moved) >= 0.5:
+            trip[0] = fix.progress
+            direction = 1 if moved > 0 else -1
+            if direction != trip[1]:
+                # Развернулся — новый рейс, уведомляем заново
+                trip[1] = direction
+                trip[2].clear()
+        direction, notified = trip[1], trip[2]
+        if direction == 0:
+            return
+
+        data = self.load_schedule()
+        route = vehicle.route
+        bus_km = route.geometry.km_at(fix.progress)
+
+        due = []
+        for chat_id, stop, place in self._targets(data, route, direction):
+            if chat_id in notified:
+                continue
+            if stop is None:
+                stop = 100 if direction > 0 else 0
+            stop_km = route.geometry.km_at(stop)
+            if 0 <= (stop_km - bus_km) * direction <= self.approach_km:
+                notified.add(chat_id)
+                due.append((chat_id, stop_km, place))
+        if not due:
+            return
+
+        # ETA всем адресатам одним пакетным расчётом
+        etas = route.speeds.travel_minutes_many(bus_km, [stop_km for _, stop_km, _ in due])
+        batch = [
+            (chat_id, f"🚌 Автобус подъезжает к {place}: ~{max(1, round(float(minutes)))} мин")
+            for (chat_id, _, place), minutes in zip(due, etas)
+        ]
+        await asyncio.gather(*(self._send(chat_id, text) for chat_id, text in batch))
+
+    async def _send(self, chat_id, text):
+        for _ in range(3):
+            # Без своего лимитера отправка идёт через общую очередь бота
+            if self.limiter is not None:
+                await self.limiter.wait(chat_id)
+            try:
+                await self.bot.send_message(chat_id, text)
+                return
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                log.warning(f"Не удалось уведомить {chat_id}: {e}")
+                return
@@ -0,0 +1,139 @@
+from math import floor
+from pathlib import Path
+
+from gps import Fix, PositionStore
+from route import Route, SegmentSpeeds, default_route, load_route
+from timetable import fmt_minutes, to_minutes
+
+COARSE_DEG = 0.05  # ~5 км: грубая сетка «ячейка → маршруты рядом»
+
+
+# 🛣️ Маршрут: направления (туда, обратно), геометрия и скорости по участкам
+class RouteInfo:
+    def __init__(self, route_id, name, directions, geometry: Route, speeds: SegmentSpeeds,
+                 return_shift=None, cases=None, gtfs_route_id=None):
+        if len(directions) != 2:
+            raise ValueError(f"У маршрута {route_id} должно быть два направления: туда и обратно")
+        self.id = route_id
+        self.name = name
+        self.directions = tuple(directions)
+        self.start, self.end = self.directions[0].split('→')
+        self.geometry = geometry
+        self.speeds = speeds
+        self.return_shift = return_shift
+        self.cases = cases or {}
+        self.gtfs_route_id = gtfs_route_id  # route_id этого маршрута в GTFS перевозчика
+
+    def place(self, name, case):
+        # Название в нужном падеже: 'где' (в Жирновске), 'род' (Жирновска), 'дат' (Жирновску)
+        form = self.cases.get(name, {}).get(case)
+        if form:
+            return form
+        return f"у «{name}»" if case == 'где' else f"«{name}»"
+
+    def derive_return(self, times):
+        # Обратные рейсы по рейсам «туда»: сдвиг в минутах или прежнее правило «HH:30»
+        if self.return_shift is None:
+            return [f"{t[:3]}30" for t in times]
+        return [fmt_minutes((to_minutes(t) + self.return_shift) % (24 * 60)) for t in times]
+
+
+# 🚍 Автобус: маршрут, водитель и собственный кольцевой буфер GPS
+class Vehicle:
+    def __init__(self, vehicle_id, route: RouteInfo, driver_id, positions: PositionStore):
+        self.id = vehicle_id
+        self.route = route
+        self.driver_id = driver_id
+        self.positions = positions
+
+
+# 📇 Реестр: маршрут → направления, направление → маршрут, водитель → автобус
+class Registry:
+    def __init__(self):
+        self.routes = {}
+        self.by_direction = {}
+        self.by_driver = {}
+        self.vehicles = {}
+        self._route_vehicles = {}
+        self._cells = {}
+
+    def add_route(self, info: RouteInfo):
+        if info.id in self.routes:
+            raise ValueError(f"Маршрут {info.id} уже есть")
+        for direction in info.directions:
+            if direction in self.by_direction:
+                raise ValueError(f"Направление {direction} уже относится к маршруту {self.by_direction[direction].id}")
+            self.by_direction[direction] = info
+        self.routes[info.id] = info
+        self._route_vehicles[info.id] = []
+
+        points = info.geometry.points
+        for (lat1, lon1), (lat2, lon2) in zip(points, points[1:]):
+            for cx in range(floor(min(lat1, lat2) / COARSE_DEG), floor(max(lat1, lat2) / COARSE_DEG) + 1):
+                for cy in range(floor(min(lon1, lon2) / COARSE_DEG), floor(max(lon1, lon2) / COARSE_DEG) + 1):
+                    self._cells.setdefault((cx, cy), set()).add(info.id)
+
+    def add_vehicle(self, vehicle: Vehicle):
+        if vehicle.driver_id in self.by_driver:
+            raise ValueError(f"Водитель {vehicle.driver_id} уже закреплён за {self.by_driver[vehicle.driver_id].id}")
+        self.vehicles[vehicle.id] = vehicle
+        self.by_driver[vehicle.driver_id] = vehicle
+        self._route_vehicles[vehicle.route.id].append(vehicle)
+
+    def vehicles_of(self, route_id):
+        return self._route_vehicles.get(route_id, ())
+
+    def locate(self, lat, lon):
+        # Ближайший маршрут → (маршрут, км от начала, удаление в км)
+        cx, cy = floor(lat / COARSE_DEG), floor(lon / COARSE_DEG)
+        candidates = set()
+        for ix in (cx - 1, cx, cx + 1):
+            for iy in (cy - 1, cy, cy + 1):
+                candidates |= self._cells.get((ix, iy), set())
+        best = None
+        for route_id in candidates or self.routes:
+            info = self.routes[route_id]
+            km, offset = info.geometry.project(lat, lon)
+            if best is None or offset < best[2]:
+                best = (info, km, offset)
+        return best
+
+    def close(self):
+        for vehicle in self.vehicles.values():
+            vehicle.positions.close()
+
+
+def build_registry(routes_cfg, vehicles_cfg, default_speed=45, route_file=None, gps_file=None, gps_history=256,
+                   gps_suffix='', history=None):
+    # history(автобус) → строки (ts, lat, lon, progress) из архива GPS; без неё — только кольцевой буфер
+    registry = Registry()
+    for route_id, cfg in routes_cfg.items():
+        if cfg.get('файл'):
+            geometry = load_route(cfg['файл'])
+        elif cfg.get('остановки'):
+            stops = [tuple(stop) for stop in cfg['остановки']]
+            geometry = Route([(lat, lon) for _, lat, lon in stops], stops)
+        elif route_file is not None and len(routes_cfg) == 1 and Path(route_file).exists():
+            geometry = load_route(route_file)
+        else:
+            geometry = default_route()
+        speeds = SegmentSpeeds(geometry, cfg.get('скорость_кмч', default_speed))
+        registry.add_route(RouteInfo(
+            route_id, cfg.get('название', route_id), cfg['направления'], geometry, speeds,
+            cfg.get('обратный_сдвиг_мин'), cfg.get('падежи'), cfg.get('gtfs_route_id'),
+        ))
+
+    for vehicle_id, cfg in vehicles_cfg.items():
+        path = cfg.get('файл_gps') or (gps_file if gps_file and len(vehicles_cfg) == 1 else f'bus_position_{vehicle_id}{gps_suffix}.bin')
+        registry.add_vehicle(Vehicle(
+            vehicle_id, registry.routes[cfg['маршрут']], cfg['водитель'], PositionStore(Path(path), gps_history),
+        ))
+
+    # Скорости учим по накопленной истории каждого автобуса
+    for vehicle in registry.vehicles.values():
+        geometry, speeds = vehicle.route.geometry, vehicle.route.speeds
+        fixes = [Fix(lat, lon, ts, progress) for ts, lat, lon, progress in history(vehicle.id)] if history else []
+        fixes = fixes or vehicle.positions.recent()
+        for prev, fix in zip(fixes, fixes[1:]):
+            speeds.learn(geometry.km_at(prev.progress), prev.time, geometry.km_at(fix.progress), fix.time)
+    return registry
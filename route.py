@@ -0,0 +1,196 @@
+import csv
+import json
+from bisect import bisect_right
+from math import radians, cos, sqrt, floor
+from pathlib import Path
+
+from geo import EARTH_KM, np
+
+CELL_KM = 0.5          # размер ячейки сетки пространственного индекса
+MAX_RING = 4           # дальше этого числа колец ячеек — полный перебор
+SPEED_ALPHA = 0.2      # вес новой отметки в скользящей скорости участка
+MIN_SPEED_KMH, MAX_SPEED_KMH = 3, 110
+BATCH_CELLS = 1_000_000  # точек × участков за один проход numpy
+
+# Прямая между конечными — если файла маршрута нет
+DEFAULT_STOPS = [('Жирновск', 50.976412, 44.777647), ('Медведица', 51.082652, 44.816874)]
+
+
+# 🛣️ Маршрут: ломаная с накопленными расстояниями и сеткой по участкам
+class Route:
+    def __init__(self, points, stops=()):
+        if len(points) < 2:
+            raise ValueError("В маршруте нужно хотя бы две точки")
+        self.points = [(float(lat), float(lon)) for lat, lon in points]
+        self.lat0 = sum(p[0] for p in self.points) / len(self.points)
+        self.lon0 = sum(p[1] for p in self.points) / len(self.points)
+        self._kx = radians(1) * EARTH_KM * cos(radians(self.lat0))
+        self._ky = radians(1) * EARTH_KM
+        self.xy = [self._to_xy(lat, lon) for lat, lon in self.points]
+
+        self.cum = [0.0]
+        for (x1, y1), (x2, y2) in zip(self.xy, self.xy[1:]):
+            self.cum.append(self.cum[-1] + sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2))
+        self.length = self.cum[-1]
+
+        self._grid = {}
+        for i, ((x1, y1), (x2, y2)) in enumerate(zip(self.xy, self.xy[1:])):
+            for cx in range(floor(min(x1, x2) / CELL_KM), floor(max(x1, x2) / CELL_KM) + 1):
+                for cy in range(floor(min(y1, y2) / CELL_KM), floor(max(y1, y2) / CELL_KM) + 1):
+                    self._grid.setdefault((cx, cy), []).append(i)
+
+        self.stops = {name: self.project(lat, lon)[0] for name, lat, lon in stops}
+
+    def _to_xy(self, lat, lon):
+        return (lon - self.lon0) * self._kx, (lat - self.lat0) * self._ky
+
+    def _project_segment(self, i, x, y):
+        (x1, y1), (x2, y2) = self.xy[i], self.xy[i + 1]
+        dx, dy = x2 - x1, y2 - y1
+        seg2 = dx * dx + dy * dy
+        t = 0.0 if seg2 == 0 else max(0.0, min(1.0, ((x - x1) * dx + (y - y1) * dy) / seg2))
+        px, py = x1 + t * dx, y1 + t * dy
+        return (x - px) ** 2 + (y - py) ** 2, self.cum[i] + t * (self.cum[i + 1] - self.cum[i])
+
+    def project(self, lat, lon):
+        # → (км от начала маршрута, удаление от маршрута в км)
+        x, y = self._to_xy(lat, lon)
+        cx, cy = floor(x / CELL_KM), floor(y / CELL_KM)
+        best = None
+        # Обходим кольца ячеек, пока ближе найденного участка может оказаться другой
+        for ring in range(MAX_RING + 1):
+            for ix in range(cx - ring, cx + ring + 1):
+                for iy in range(cy - ring, cy + ring + 1):
+                    if max(abs(ix - cx), abs(iy - cy)) != ring:
+                        continue
+                    for i in self._grid.get((ix, iy), ()):
+                        candidate = self._project_segment(i, x, y)
+                        if best is None or candidate[0] < best[0]:
+                            best = candidate
+            if best is not None and sqrt(best[0]) <= ring * CELL_KM:
+                break
+        else:
+            # Далеко от маршрута — полный перебор дешевле обхода пустых колец
+            best = min(self._project_segment(i, x, y) for i in range(len(self.xy) - 1))
+        return best[1], sqrt(best[0])
+
+    def project_many(self, lats, lons):
+        # Пакетная проекция: → (массив км от начала, массив удалений в км)
+        if np is None:
+            return tuple(map(list, zip(*(self.project(lat, lon) for lat, lon in zip(lats, lons))))) or ([], [])
+        xy = np.asarray(self.xy)
+        x1, y1 = xy[:-1, 0], xy[:-1, 1]
+        dx, dy = np.diff(xy[:, 0]), np.diff(xy[:, 1])
+        seg2 = np.where(dx * dx + dy * dy == 0, 1, dx * dx + dy * dy)
+        cum = np.asarray(self.cum)
+        x = (np.asarray(lons, dtype=float) - self.lon0) * self._kx
+        y = (np.asarray(lats, dtype=float) - self.lat0) * self._ky
+
+        km, offset = np.empty(len(x)), np.empty(len(x))
+        step = max(1, BATCH_CELLS // len(x1))
+        for start in range(0, len(x), step):
+            px, py = x[start:start + step, None], y[start:start + step, None]
+            t = np.clip(((px - x1) * dx + (py - y1) * dy) / seg2, 0, 1)
+            d2 = (px - x1 - t * dx) ** 2 + (py - y1 - t * dy) ** 2
+            best = d2.argmin(axis=1)
+            rows = np.arange(len(best))
+            km[start:start + step] = cum[best] + t[rows, best] * (cum[best + 1] - cum[best])
+            offset[start:start + step] = np.sqrt(d2[rows, best])
+        return km, offset
+
+    def km_at(self, progress):
+        return self.length * progress / 100
+
+    def segment_at(self, km):
+        return min(max(bisect_right(self.cum, km) - 1, 0), len(self.cum) - 2)
+
+
+# ⏱️ Скорости по участкам, выученные по отметкам водителя
+class SegmentSpeeds:
+    def __init__(self, route: Route, default_kmh: float = 45):
+        self.route = route
+        self.default_kmh = default_kmh
+        self.speeds = [default_kmh] * (len(route.cum) - 1)
+        self._minutes = None
+
+    def learn(self, km1, t1, km2, t2):
+        dt = t2 - t1
+        if not 0 < dt <= 600:
+            return
+        speed = abs(km2 - km1) / (dt / 3600)
+        if not MIN_SPEED_KMH <= speed <= MAX_SPEED_KMH:
+            return
+        lo, hi = sorted((km1, km2))
+        for i in range(self.route.segment_at(lo), self.route.segment_at(hi) + 1):
+            self.speeds[i] += SPEED_ALPHA * (speed - self.speeds[i])
+        self._minutes = None
+
+    def _prefix_minutes(self):
+        # Накопленное время от начала маршрута до каждой вершины
+        if self._minutes is None:
+            minutes = [0.0]
+            cum = self.route.cum
+            for i, speed in enumerate(self.speeds):
+                minutes.append(minutes[-1] + (cum[i + 1] - cum[i]) / speed * 60)
+            self._minutes = minutes
+        return self._minutes
+
+    def _minutes_at(self, km):
+        i = self.route.segment_at(km)
+        cum = self.route.cum
+        return self._prefix_minutes()[i] + (km - cum[i]) / self.speeds[i] * 60
+
+    def travel_minutes(self, km_from, km_to):
+        return abs(self._minutes_at(km_to) - self._minutes_at(km_from))
+
+    def travel_minutes_many(self, km_from, km_to):
+        # Как travel_minutes, но для массивов (или массива и числа)
+        if np is None:
+            n = max(len(x) for x in (km_from, km_to) if hasattr(x, '__len__'))
+            pick = lambda x, i: x[i] if hasattr(x, '__len__') else x
+            return [self.travel_minutes(pick(km_from, i), pick(km_to, i)) for i in range(n)]
+        cum = np.asarray(self.route.cum)
+        minutes = np.asarray(self._prefix_minutes())
+        speeds = np.asarray(self.speeds)
+
+        def minutes_at(km):
+            km = np.asarray(km, dtype=float)
+            i = np.clip(np.searchsorted(cum, km, side='right') - 1, 0, len(cum) - 2)
+            return minutes[i] + (km - cum[i]) / speeds[i] * 60
+
+        return np.abs(minutes_at(km_to) - minutes_at(km_from))
+
+
+# 🚌 ETA для многих пассажиров разом по одной отметке автобуса, минуты
+def batch_eta(route: Route, speeds: SegmentSpeeds, bus_progress, user_lats, user_lons):
+    user_km, _ = route.project_many(user_lats, user_lons)
+    return speeds.travel_minutes_many(route.km_at(bus_progress), user_km)
+
+
+def load_route(path: Path) -> Route:
+    path = Path(path)
+    points, stops = [], []
+    if path.suffix.lower() == '.csv':
+        # lat,lon[,name] — каждая строка вершина ломаной, строки с name ещё и остановки
+        with open(path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                lat, lon = float(row['lat']), float(row['lon'])
+                points.append((lat, lon))
+                if row.get('name'):
+                    stops.append((row['name'], lat, lon))
+    else:
+        with open(path, encoding='utf-8') as f:
+            geo = json.load(f)
+        features = geo['features'] if geo.get('type') == 'FeatureCollection' else [geo]
+        for feature in features:
+            geometry = feature.get('geometry', feature)
+            if geometry['type'] == 'LineString':
+                points.extend((lat, lon) for lon, lat, *_ in geometry['coordinates'])
+            elif geometry['type'] == 'Point':
+                lon, lat = geometry['coordinates'][:2]
+                stops.append((feature.get('properties', {}).get('name', ''), lat, lon))
+    return Route(points, stops)
+
+
+def default_route() -> Route:
+    return Route([(lat, lon) for _, lat, lon in DEFAULT_STOPS], DEFAULT_STOPS)
@@ -0,0 +1,496 @@
+import os
+import json
+import time
+import hashlib
+import asyncio
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+
+# 💾 Атомарная запись: временный файл + rename
+def atomic_write(path: Path, text: str):
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def dump_json(data) -> str:
+    return json.dumps(data, ensure_ascii=False, indent=2)
+
+
+class VersionConflict(Exception):
+    """Раздел документа изменили после того, как его прочитали"""
+
+
+def section_hash(value) -> str:
+    # Отпечаток содержимого раздела: в отличие от счётчика версий, одинаков и после перезапуска
+    return hashlib.sha1(json.dumps(value, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+_MISSING = object()
+
+
+# ✏️ Маленькие правки документа вместо перезаписи целиком:
+# ('set', путь, значение), ('delete', путь), ('add', путь, элемент), ('remove', путь, элемент)
+# → множество изменённых разделов верхнего уровня
+# delete и remove не создают промежуточных словарей и убирают опустевшие списки и словари
+# внутри раздела — кроме KEEP_EMPTY, где пустой список что-то значит
+KEEP_EMPTY = {'изменения'}  # [] — в этот день рейсов нет
+
+
+def _prune(data, path):
+    # Снизу вверх убираем опустевшее, сам раздел верхнего уровня оставляем
+    nodes = [data]
+    for key in path[:-1]:
+        nodes.append(nodes[-1][key])
+    for depth in range(len(path) - 1, 0, -1):
+        node, key = nodes[depth], path[depth]
+        value = node[key]
+        if value or (isinstance(value, list) and path[0] in KEEP_EMPTY):
+            break
+        del node[key]
+
+
+def apply_patch(data, ops):
+    changed = set()
+    for op, path, *value in ops:
+        *parents, last = path
+        node = data
+        if op in ('delete', 'remove'):
+            for key in parents:
+                node = node.get(key)
+                if not isinstance(node, dict):
+                    break
+            if not isinstance(node, dict):
+                continue
+        else:
+            for key in parents:
+                node = node.setdefault(key, {})
+        if op == 'set':
+            if node.get(last, _MISSING) == value[0]:
+                continue
+            node[last] = value[0]
+        elif op == 'delete':
+            if last not in node:
+                continue
+            del node[last]
+            _prune(data, parents)
+        elif op == 'add':
+            items = node.setdefault(last, [])
+            if value[0] in items:
+                continue
+            items.append(value[0])
+        elif op == 'remove':
+            items = node.get(last, [])
+            if value[0] not in items:
+                continue
+            node[last] = [item for item in items if item != value[0]]
+            _prune(data, path)
+        else:
+            raise ValueError(f"Неизвестная операция: {op}")
+        changed.add(path[0])
+    return changed
+
+
+# 📄 Хранение целиком в schedule.json
+class JsonBackend:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._mtime = None
+
+    def _stamp(self):
+        return self.path.stat().st_mtime_ns if self.path.exists() else None
+
+    def is_empty(self):
+        return not self.path.exists()
+
+    def read(self):
+        self._mtime = self._stamp()
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def changed(self):
+        # Файл переписал кто-то другой (мы после своей записи запоминаем время)
+        return self._mtime is not None and self._stamp() != self._mtime
+
+    def snapshot(self, data, keys=None):
+        return dump_json(data)
+
+    def write(self, snapshot):
+        atomic_write(self.path, snapshot)
+        self._mtime = self._stamp()
+
+    def append_fixes(self, rows):
+        pass  # история GPS в JSON не ведётся, есть только кольцевой буфер
+
+    def fixes(self, vehicle, since=0):
+        return []
+
+    def close(self):
+        pass
+
+
+# Разделы «дата → направление → значение», которые лежат построчно:
+# раздел → (таблица, столбец даты, столбец значения)
+ROW_SECTIONS = {
+    'изменения': ('overrides', 'date', 'times'),
+    'отклонения': ('deltas', 'period', 'delta'),
+}
+
+
+# 🗃️ Хранение в SQLite (WAL): праздники, изменения и отклонения — строки с ключом по дате,
+# остальные разделы документа — по строке на ключ, история GPS — отдельная таблица
+# (по ней при старте учатся скорости; старше history_days дней — удаляется)
+class SqliteBackend:
+    PRUNE_EVERY = 3600  # сек между чистками истории GPS
+
+    def __init__(self, path: Path, migrate_from: Path = None, history_days: float = None):
+        self.path = Path(path)
+        self.history_days = history_days
+        self._pruned = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS doc (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS holidays (date TEXT PRIMARY KEY)')
+            for table, key, value in ROW_SECTIONS.values():
+                self._db.execute(f'''CREATE TABLE IF NOT EXISTS {table} (
+                    {key} TEXT NOT NULL,
+                    direction TEXT NOT NULL,
+                    {value} TEXT NOT NULL,
+                    PRIMARY KEY ({key}, direction)
+                )''')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS gps_history (
+                vehicle TEXT NOT NULL,
+                ts REAL NOT NULL,
+                lat REAL NOT NULL,
+                lon REAL NOT NULL,
+                progress REAL NOT NULL
+            )''')
+            self._db.execute('CREATE INDEX IF NOT EXISTS gps_history_vehicle_ts ON gps_history (vehicle, ts)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS gps_history_ts ON gps_history (ts)')
+        self._written = None
+        self._snapshot = None
+        self._data_version = None
+
+        if migrate_from is not None and self.is_empty() and Path(migrate_from).exists():
+            # Разовый перенос из schedule.json; сам файл не трогаем — остаётся резервной копией
+            log.info("Переношу %s в %s", migrate_from, self.path)
+            self.write(self.snapshot(JsonBackend(migrate_from).read()))
+
+    def is_empty(self):
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM doc LIMIT 1').fetchone() is None
+
+    def read(self):
+        with self._lock:
+            self._data_version = self._db.execute('PRAGMA data_version').fetchone()[0]
+            data = {key: json.loads(value) for key, value in self._db.execute('SELECT key, value FROM doc')}
+            data['праздники'] = [d for d, in self._db.execute('SELECT date FROM holidays ORDER BY date')]
+            for section, (table, key, value) in ROW_SECTIONS.items():
+                rows = {}
+                for date, direction, item in self._db.execute(f'SELECT {key}, direction, {value} FROM {table} ORDER BY {key}'):
+                    rows.setdefault(date, {})[direction] = json.loads(item)
+                data[section] = rows
+        self._written = self.snapshot(data)
+        return data
+
+    def snapshot(self, data, keys=None):
+        # Делается в цикле событий: только сериализация, без обращения к базе.
+        # keys — какие разделы менялись; остальные берём из прошлого снимка
+        if keys is None or self._snapshot is None:
+            keys = set(data) | {'праздники'} | ROW_SECTIONS.keys()
+            doc, holidays, rows = {}, frozenset(), {}
+        else:
+            doc, holidays, rows = self._snapshot
+            doc, rows = dict(doc), dict(rows)
+        for key in keys:
+            if key == 'праздники':
+                holidays = frozenset(data.get('праздники', []))
+            elif key in ROW_SECTIONS:
+                rows[key] = {
+                    (date, direction): json.dumps(item, ensure_ascii=False)
+                    for date, items in data.get(key, {}).items()
+                    for direction, item in items.items()
+                }
+            elif key in data:
+                doc[key] = json.dumps(data[key], ensure_ascii=False)
+            else:
+                doc.pop(key, None)
+        self._snapshot = doc, holidays, rows
+        return self._snapshot
+
+    def write(self, snapshot):
+        # Пишем только разницу с тем, что уже лежит в базе
+        doc, holidays, rows = snapshot
+        old_doc, old_holidays, old_rows = self._written or ({}, frozenset(), {})
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM doc WHERE key = ?', [(k,) for k in old_doc.keys() - doc.keys()])
+            self._db.executemany(
+                'INSERT OR REPLACE INTO doc (key, value) VALUES (?, ?)',
+                [(k, v) for k, v in doc.items() if old_doc.get(k) != v],
+            )
+            self._db.executemany('DELETE FROM holidays WHERE date = ?', [(d,) for d in old_holidays - holidays])
+            self._db.executemany('INSERT OR IGNORE INTO holidays (date) VALUES (?)', [(d,) for d in holidays - old_holidays])
+            for section, (table, key, value) in ROW_SECTIONS.items():
+                new, old = rows.get(section, {}), old_rows.get(section, {})
+                self._db.executemany(
+                    f'DELETE FROM {table} WHERE {key} = ? AND direction = ?',
+                    list(old.keys() - new.keys()),
+                )
+                self._db.executemany(
+                    f'INSERT OR REPLACE INTO {table} ({key}, direction, {value}) VALUES (?, ?, ?)',
+                    [(*k, v) for k, v in new.items() if old.get(k) != v],
+                )
+        self._written = snapshot
+
+    def changed(self):
+        # data_version растёт только от чужих соединений: другой воркер что-то записал
+        # (не обязательно документ — ещё и историю GPS, поэтому содержимое сверяет ScheduleStore)
+        with self._lock:
+            return self._db.execute('PRAGMA data_version').fetchone()[0] != self._data_version
+
+    def append_fixes(self, rows):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT INTO gps_history (vehicle, ts, lat, lon, progress) VALUES (?, ?, ?, ?, ?)', rows,
+            )
+            if self.history_days and now - self._pruned >= self.PRUNE_EVERY:
+                self._db.execute('DELETE FROM gps_history WHERE ts < ?', (now - self.history_days * 86400,))
+                self._pruned = now
+
+    def fixes(self, vehicle, since=0):
+        with self._lock:
+            return self._db.execute(
+                'SELECT ts, lat, lon, progress FROM gps_history WHERE vehicle = ? AND ts >= ? ORDER BY ts',
+                (vehicle, since),
+            ).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def make_backend(kind, json_path: Path, db_path: Path, history_days: float = None):
+    if kind == 'sqlite':
+        return SqliteBackend(db_path, migrate_from=json_path, history_days=history_days)
+    if kind == 'json':
+        return JsonBackend(json_path)
+    raise ValueError(f"Неизвестное хранилище расписания: {kind}")
+
+
+# 🗄️ Расписание в памяти, запись на диск в фоне
+# Файловая работа идёт в пуле потоков цикла событий (asyncio.to_thread),
+# одновременные сохранения склеиваются в одну запись.
+# version растёт при каждой правке; подписчики on_change узнают, какие разделы менялись.
+# Несколько воркеров на одной базе: правки других подхватываются перед patch() и в фоновом
+# цикле (refresh), при одновременной правке одного раздела побеждает записавший последним
+# Для долгих правок админа — fingerprint() разделов в начале и patch(..., expected=...) в конце
+# observe(операция, секунды) — для метрик чтения и записи
+class ScheduleStore:
+    REFRESH_INTERVAL = 2  # сек между проверками чужих правок, если фоновой записи нет
+
+    def __init__(self, backend, flush_interval: float = 2.0, observe=None):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.observe = observe
+        self.version = 0
+        self._data = None
+        self._dirty_all = False
+        self._dirty_keys = set()
+        self._listeners = []
+        self._lock = asyncio.Lock()
+        self._fixes = []
+        self._task = None
+        self._flushed = 0       # версия, которая уже на диске
+        self._inflight = None   # текущая запись, которую ждут все сохраняющие
+
+    def _observe(self, op, start):
+        if self.observe is not None:
+            self.observe(op, time.perf_counter() - start)
+
+    def load(self):
+        if self._data is None:
+            start = time.perf_counter()
+            self._data = self.backend.read()
+            self._observe('read', start)
+        return self._data
+
+    async def aload(self):
+        if self._data is None:
+            start = time.perf_counter()
+            self._data = await asyncio.to_thread(self.backend.read)
+            self._observe('read', start)
+        return self._data
+
+    def on_change(self, callback):
+        # callback(версия, разделы); разделы None — заменён весь документ
+        self._listeners.append(callback)
+
+    @property
+    def _dirty(self):
+        return self._dirty_all or bool(self._dirty_keys)
+
+    def _mark(self, data, keys=None):
+        self._data = data
+        self.version += 1
+        if keys is None:
+            self._dirty_all = True
+        else:
+            self._dirty_keys |= keys
+        for callback in self._listeners:
+            callback(self.version, keys)
+
+    def save(self, data):
+        self._mark(data)
+        # Без фонового сброса (интервал 0 или цикл не запущен) пишем сразу
+        if self.flush_interval <= 0 or self._task is None:
+            self._flush_soon()
+
+    def _flush_soon(self):
+        # В цикле событий диск не трогаем — запись уходит в поток отдельной задачей;
+        # вне цикла (инициализация) пишем синхронно
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        task = asyncio.ensure_future(self.aflush())
+        task.add_done_callback(self._flush_done)
+
+    @staticmethod
+    def _flush_done(task):
+        if not task.cancelled() and task.exception() is not None:
+            log.error("Не удалось сохранить расписание", exc_info=task.exception())
+
+    async def fingerprint(self, *keys):
+        # → {раздел: отпечаток}; хранится в данных FSM, поэтому переживает перезапуск бота
+        data = await self.aload()
+        return {key: section_hash(data.get(key)) for key in keys}
+
+    async def _refresh(self):
+        # Под self._lock: своё несохранённое — на диск, затем перечитать, если писал другой воркер
+        if self._data is None:
+            return False
+        if self._dirty or self._fixes:
+            await self.aflush()
+        if not await asyncio.to_thread(self.backend.changed):
+            return False
+        data = await asyncio.to_thread(self.backend.read)
+        if data == self._data:
+            return False
+        self._data = data
+        self.version += 1
+        self._flushed = self.version
+        for callback in self._listeners:
+            callback(self.version, None)
+        return True
+
+    async def refresh(self):
+        async with self._lock:
+            return await self._refresh()
+
+    async def patch(self, ops, expected=None, wait=True):
+        # expected — fingerprint() разделов на момент, когда админ начал правку: если они
+        # с тех пор менялись, правка не применяется (VersionConflict)
+        async with self._lock:
+            await self._refresh()
+            data = await self.aload()
+            if expected:
+                stale = {key for key, digest in expected.items() if section_hash(data.get(key)) != digest}
+                if stale:
+                    raise VersionConflict(', '.join(sorted(stale)))
+            changed = apply_patch(data, ops)
+            if changed:
+                self._mark(data, changed)
+        # wait=False — не ждать диска, запишет фоновый цикл
+        if changed and (wait or self.flush_interval <= 0):
+            await self.aflush()
+        return changed
+
+    def record_fix(self, vehicle_id, fix):
+        # Только в очередь: запишет фоновый цикл, при интервале 0 — отдельная задача
+        self._fixes.append((vehicle_id, fix.time, fix.lat, fix.lon, fix.progress))
+        if self.flush_interval <= 0:
+            self._flush_soon()
+
+    def _take(self):
+        snapshot = None
+        if self._dirty:
+            snapshot = self.backend.snapshot(self._data, None if self._dirty_all else self._dirty_keys)
+        fixes, self._fixes = self._fixes, []
+        self._dirty_all, self._dirty_keys = False, set()
+        return snapshot, fixes
+
+    def _write(self, snapshot, fixes):
+        if snapshot is not None:
+            self.backend.write(snapshot)
+        if fixes:
+            self.backend.append_fixes(fixes)
+
+    def flush(self):
+        version = self.version
+        start = time.perf_counter()
+        self._write(*self._take())
+        self._observe('write', start)
+        self._flushed = version
+
+    async def _flush_once(self):
+        # Снимок делаем в цикле событий, на диск пишем в потоке
+        version = self.version
+        start = time.perf_counter()
+        snapshot, fixes = self._take()
+        try:
+            await asyncio.to_thread(self._write, snapshot, fixes)
+        except Exception:
+            # Следующая попытка пишет весь документ — разница считается от записанного
+            self._dirty_all = snapshot is not None or self._dirty
+            self._fixes[:0] = fixes
+            raise
+        finally:
+            self._inflight = None
+        self._observe('write', start)
+        self._flushed = version
+
+    async def aflush(self):
+        target = self.version
+        while self._flushed < target or (self._fixes and self._inflight is None):
+            if self._inflight is None:
+                self._inflight = asyncio.ensure_future(self._flush_once())
+            await asyncio.shield(self._inflight)
+
+    async def _flush_loop(self):
+        # Заодно подхватываем правки других воркеров; при интервале 0 — раз в REFRESH_INTERVAL
+        while True:
+            await asyncio.sleep(self.flush_interval if self.flush_interval > 0 else self.REFRESH_INTERVAL)
+            try:
+                await self.refresh()
+            except Exception:
+                log.exception("Не удалось сохранить или перечитать расписание")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._inflight is not None:
+            await asyncio.gather(self._inflight, return_exceptions=True)
+        self.flush()
+        self.backend.close()
@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+
+from gps import PositionStore
+from ingest import FixChannel, FixIngest
+from route import DEFAULT_STOPS, default_route
+
+(_, LAT0, LON0), (_, LAT1, LON1) = DEFAULT_STOPS
+
+
+def point(share):
+    # Точка на прямой между конечными: 0 — начало, 1 — конец
+    return LAT0 + (LAT1 - LAT0) * share, LON0 + (LON1 - LON0) * share
+
+
+def make_vehicle(tmp_path):
+    return SimpleNamespace(id='bus', route=SimpleNamespace(geometry=default_route()), positions=PositionStore(tmp_path / 'gps.bin'))
+
+
+def test_long_stop_does_not_extrapolate(tmp_path):
+    # Едет ~40 км/ч (маршрут ~12 км), потом полчаса стоит на месте и едет дальше
+    vehicle = make_vehicle(tmp_path)
+    ingest = FixIngest(FixChannel())
+    ts = 1_000_000.0
+    share = 0.2
+    for _ in range(10):
+        assert ingest.accept(vehicle, *point(share), ts) is not None
+        ts += 10
+        share += 0.01
+
+    stop = share - 0.01
+    ts += 30 * 60
+    after_stop = ingest.accept(vehicle, *point(stop), ts)
+    assert after_stop is not None
+    assert abs(after_stop.progress - stop * 100) < 1
+
+    moved = ingest.accept(vehicle, *point(stop + 0.01), ts + 10)
+    assert moved is not None
+    assert abs(moved.progress - (stop + 0.01) * 100) < 1
+
+
+def test_jump_is_rejected(tmp_path):
+    vehicle = make_vehicle(tmp_path)
+    ingest = FixIngest(FixChannel())
+    assert ingest.accept(vehicle, *point(0.2), 1_000_000.0) is not None
+    assert ingest.accept(vehicle, *point(0.8), 1_000_010.0) is None
+    assert ingest.accept(vehicle, *point(0.21), 1_000_020.0) is not None
@@ -0,0 +1,126 @@
+import time
+import asyncio
+import logging
+from contextvars import ContextVar
+from datetime import datetime
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.exceptions import TelegramRetryAfter
+
+from notify import TokenBucket, SendLimiter
+
+log = logging.getLogger(__name__)
+
+# Флаги хендлеров:
+# flags={'throttle': (в секунду, запас)} — ведро токенов на пользователя
+# flags={'reuse': секунды} — одинаковые запросы пользователя за это время получают прошлый ответ,
+#                            а пока первый ещё считается, повторы просто ждут его
+
+# Сюда складываются отправки хендлера, чтобы потом повторить их без пересчёта
+_recording = ContextVar('recording', default=None)
+
+
+# 🐢 Ведро токенов на пользователя: лишние апдейты отбрасываются, предупреждение — один раз
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(self, notice="⏳ Не так часто — подождите пару секунд"):
+        self.notice = notice
+        self._buckets = {}  # (пользователь, хендлер) → [ведро, уже предупредили]
+
+    async def __call__(self, handler, event, data):
+        limit = get_flag(data, 'throttle')
+        if limit is None or event.from_user is None:
+            return await handler(event, data)
+
+        key = (event.from_user.id, data['handler'].callback.__name__)
+        entry = self._buckets.get(key)
+        if entry is None:
+            entry = self._buckets[key] = [TokenBucket(*limit), False]
+        if entry[0].try_take():
+            entry[1] = False
+            return await handler(event, data)
+
+        if not entry[1]:
+            entry[1] = True
+            await event.answer(self.notice)
+        if len(self._buckets) > 10_000:
+            # Полные вёдра ничего не помнят — их можно выбросить
+            self._buckets = {k: v for k, v in self._buckets.items() if v[0].tokens < v[0].capacity}
+        return None
+
+
+# ♻️ Склейка одинаковых запросов и короткое переиспользование ответа
+# version() входит в ключ: после правки расписания старые ответы не отдаются
+class ReplyReuseMiddleware(BaseMiddleware):
+    def __init__(self, version=lambda: 0):
+        self.version = version
+        self._replies = {}   # ключ → (годен до, отправленные методы)
+        self._inflight = {}  # ключ → future, который ждут повторы
+
+    def _key(self, event, data):
+        if event.location is not None:
+            # ~100 м: стоящий на остановке пассажир шлёт почти одно и то же
+            payload = (round(event.location.latitude, 3), round(event.location.longitude, 3))
+        else:
+            payload = event.text
+        today = datetime.now().strftime('%Y-%m-%d')
+        return event.from_user.id, data['handler'].callback.__name__, today, self.version(), payload
+
+    async def __call__(self, handler, event, data):
+        ttl = get_flag(data, 'reuse')
+        if ttl is None or event.from_user is None:
+            return await handler(event, data)
+
+        key = self._key(event, data)
+        cached = self._replies.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            for method in cached[1]:
+                await data['bot'](method)
+            return None
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            # Такой же запрос уже считается — ответ придёт от него
+            await asyncio.shield(inflight)
+            return None
+
+        future = self._inflight[key] = asyncio.get_running_loop().create_future()
+        sent = []
+        token = _recording.set(sent)
+        try:
+            result = await handler(event, data)
+            # Пусто — отправки не записались (нет SendQueueMiddleware), повторять нечего
+            if sent:
+                self._replies[key] = (time.monotonic() + ttl, sent)
+            if len(self._replies) > 10_000:
+                now = time.monotonic()
+                self._replies = {k: v for k, v in self._replies.items() if v[0] > now}
+            return result
+        finally:
+            _recording.reset(token)
+            del self._inflight[key]
+            future.set_result(None)
+
+
+# 📤 Общая очередь отправки: лимиты Telegram и повтор после 429
+class SendQueueMiddleware(BaseRequestMiddleware):
+    def __init__(self, limiter: SendLimiter, retries=3):
+        self.limiter = limiter
+        self.retries = retries
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        if isinstance(chat_id, int):
+            sent = _recording.get()
+            if sent is not None:
+                sent.append(method)
+            for _ in range(self.retries):
+                await self.limiter.wait(chat_id)
+                try:
+                    return await make_request(bot, method)
+                except TelegramRetryAfter as e:
+                    log.warning(f"429 для {chat_id}, жду {e.retry_after} с")
+                    await asyncio.sleep(e.retry_after)
+            await self.limiter.wait(chat_id)
+        return await make_request(bot, method)
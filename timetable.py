@@ -0,0 +1,133 @@
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from datetime import date
+from itertools import accumulate
+
+# 🗓️ Скомпилированное расписание на конкретную дату
+# departures: направление → отсортированный кортеж минут от начала суток
+# labels: направление → те же времена строками 'HH:MM'
+DayTimetable = namedtuple('DayTimetable', 'date day_type departures labels')
+
+MAX_CACHED_DAYS = 64
+
+
+def to_minutes(t: str) -> int:
+    h, m = t.split(':')
+    return int(h) * 60 + int(m)
+
+
+def fmt_minutes(minutes: int) -> str:
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def compile_times(times):
+    return tuple(sorted({to_minutes(t) for t in times}))
+
+
+def parse_period(period: str):
+    # 'YYYY-MM-DD' или 'YYYY-MM-DD..YYYY-MM-DD' → (начало, конец) включительно
+    start, _, end = period.partition('..')
+    return start, end or start
+
+
+def fmt_period(start: str, end: str) -> str:
+    return start if start == end else f"{start}..{end}"
+
+
+def expired_ops(data, today: str):
+    # Правки для store.apply_patch: убрать замены прошедших дней и отклонения, чей период кончился
+    ops = [('delete', ('изменения', date_str)) for date_str in data.get('изменения', {}) if date_str < today]
+    ops += [('delete', ('отклонения', period)) for period in data.get('отклонения', {}) if parse_period(period)[1] < today]
+    return ops
+
+
+# 📆 Интервальный индекс диапазонов дат: отсортированы по началу,
+# max_end[i] — самый поздний конец среди первых i+1, чтобы вовремя остановить обход
+class IntervalIndex:
+    def __init__(self, intervals):
+        self._items = sorted(intervals, key=lambda item: (item[0], item[1]))
+        self._starts = [start for start, _, _ in self._items]
+        self._max_end = list(accumulate((end for _, end, _ in self._items), max))
+
+    def at(self, point):
+        # Значения всех диапазонов, содержащих point, по возрастанию начала
+        found = []
+        for i in range(bisect_right(self._starts, point) - 1, -1, -1):
+            if self._max_end[i] < point:
+                break
+            start, end, value = self._items[i]
+            if end >= point:
+                found.append(value)
+        found.reverse()
+        return found
+
+
+class TimetableResolver:
+    def __init__(self, load):
+        self._load = load
+        self._compiled = None
+        self._days = {}
+        self.version = 0
+
+    def invalidate(self):
+        self._compiled = None
+        self._days.clear()
+        self.version += 1
+
+    def _compile(self):
+        data = self._load()
+        holidays = frozenset(data.get('праздники', []))
+        base = {
+            day_type: {direction: compile_times(times) for direction, times in directions.items()}
+            for day_type, directions in data['базовое_расписание'].items()
+        }
+        overrides = {
+            date_str: {direction: compile_times(times) for direction, times in changes.items()}
+            for date_str, changes in data.get('изменения', {}).items()
+        }
+        # Отклонения от базы: период → направление → {'-': [снятые], '+': [добавленные]}
+        deltas = IntervalIndex(
+            (*parse_period(period), (
+                direction, frozenset(compile_times(delta.get('-', ()))), compile_times(delta.get('+', ())),
+            ))
+            for period, directions in data.get('отклонения', {}).items()
+            for direction, delta in directions.items()
+        )
+        self._compiled = (holidays, base, overrides, deltas)
+        return self._compiled
+
+    def day(self, date_str: str) -> DayTimetable:
+        cached = self._days.get(date_str)
+        if cached is not None:
+            return cached
+
+        holidays, base, overrides, deltas = self._compiled or self._compile()
+        weekday = date.fromisoformat(date_str).weekday()
+        if date_str in holidays or weekday == 6:
+            day_type = 'выходной'
+        elif weekday == 5:
+            day_type = 'суббота'
+        else:
+            day_type = 'будни'
+
+        departures = {}
+        if day_type != 'выходной':
+            departures = dict(base.get(day_type, {}))
+            replaced = overrides.get(date_str, {})
+            departures.update(replaced)
+            for direction, minus, plus in deltas.at(date_str):
+                if direction in replaced:
+                    continue  # замена на весь день окончательна: отклонения к ней не применяются
+                times = departures.get(direction, ())
+                departures[direction] = tuple(sorted({t for t in times if t not in minus}.union(plus)))
+        labels = {direction: tuple(map(fmt_minutes, times)) for direction, times in departures.items()}
+
+        if len(self._days) >= MAX_CACHED_DAYS:
+            self._days.clear()
+        day = self._days[date_str] = DayTimetable(date_str, day_type, departures, labels)
+        return day
+
+    def next_departure(self, direction: str, date_str: str, minute: int):
+        times = self.day(date_str).departures.get(direction, ())
+        i = bisect_left(times, minute)
+        return times[i] if i < len(times) else None
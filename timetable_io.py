@@ -0,0 +1,318 @@
+import io
+import csv
+import sys
+import json
+import zipfile
+import argparse
+from array import array
+from collections import namedtuple
+from contextlib import contextmanager
+from pathlib import Path
+
+from timetable import fmt_minutes
+
+# 📦 Импорт и экспорт базового расписания
+# CSV:  day,direction,time — по строке на рейс (day: будни / суббота)
+# JSON: {"будни": {"направление": ["HH:MM", ...]}, "суббота": {...}}
+# GTFS: zip или каталог с calendar.txt, trips.txt, stop_times.txt (+ routes.txt, stops.txt при экспорте);
+#       рейс — время отправления с первой остановки, direction_id 0/1 — туда/обратно;
+#       route_id перевозчика сопоставляется маршруту ключом 'gtfs_route_id' в 'маршруты' (или --route)
+# Файлы читаются построчно: в памяти только компактные массивы минут по (день, направление)
+
+DAY_TYPES = ('будни', 'суббота')
+WEEKDAY_COLUMNS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday')
+MAX_ERRORS = 20  # сколько ошибок показывать, остальные только считаются
+
+# base: день → направление → отсортированные 'HH:MM'
+ImportResult = namedtuple('ImportResult', 'base rows skipped errors')
+
+
+def parse_time(text: str, max_hours=47) -> int:
+    # 'H:MM', 'HH:MM' или 'HH:MM:SS' → минуты от начала суток; GTFS '25:10' — это 01:10
+    parts = text.strip().split(':')
+    if len(parts) not in (2, 3) or not all(p.isdigit() for p in parts) or len(parts[1]) != 2:
+        raise ValueError(f"неверное время «{text.strip()}»")
+    hours, minutes = int(parts[0]), int(parts[1])
+    if minutes > 59 or hours > max_hours:
+        raise ValueError(f"неверное время «{text.strip()}»")
+    return (hours * 60 + minutes) % (24 * 60)
+
+
+def parse_time_list(text: str):
+    # '06:20, 7:05,abc' → (['06:20', '07:05'], ['abc'])
+    minutes, bad = set(), []
+    for item in filter(None, (t.strip() for t in text.split(','))):
+        try:
+            minutes.add(parse_time(item, max_hours=23))
+        except ValueError:
+            bad.append(item)
+    return [fmt_minutes(m) for m in sorted(minutes)], bad
+
+
+class _Collector:
+    def __init__(self, directions=None):
+        self.directions = directions  # допустимые направления или None — любые
+        self._times = {}
+        self.rows = 0
+        self.skipped = 0
+        self.errors = []
+
+    def error(self, where, message):
+        self.skipped += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append(f"{where}: {message}")
+
+    def add(self, where, day, direction, time_text):
+        if day not in DAY_TYPES:
+            return self.error(where, f"неизвестный тип дня «{day}»")
+        if not direction or (self.directions is not None and direction not in self.directions):
+            return self.error(where, f"неизвестное направление «{direction}»")
+        try:
+            minutes = parse_time(time_text)
+        except ValueError as e:
+            return self.error(where, str(e))
+        self._times.setdefault((day, direction), array('H')).append(minutes)
+        self.rows += 1
+
+    def result(self):
+        base = {}
+        for (day, direction), minutes in self._times.items():
+            base.setdefault(day, {})[direction] = [fmt_minutes(m) for m in sorted(set(minutes))]
+        return ImportResult(base, self.rows, self.skipped, self.errors)
+
+
+def read_csv(stream, directions=None) -> ImportResult:
+    collector = _Collector(directions)
+    for line, row in enumerate(csv.DictReader(stream), start=2):
+        collector.add(f"строка {line}", (row.get('day') or '').strip(), (row.get('direction') or '').strip(), row.get('time') or '')
+    return collector.result()
+
+
+def read_json(stream, directions=None) -> ImportResult:
+    collector = _Collector(directions)
+    data = json.load(stream)
+    if not isinstance(data, dict):
+        raise ValueError("ожидался объект {тип дня: {направление: [время, ...]}}")
+    for day, by_direction in data.items():
+        for direction, times in (by_direction or {}).items():
+            for i, time_text in enumerate(times):
+                collector.add(f"{day}/{direction}[{i}]", day, direction, str(time_text))
+    return collector.result()
+
+
+@contextmanager
+def _gtfs_opener(source):
+    # Каталог, путь к zip или байты zip → open(имя) с текстовым потоком
+    if isinstance(source, (str, Path)) and Path(source).is_dir():
+        yield lambda name: open(Path(source) / name, newline='', encoding='utf-8-sig')
+        return
+    with zipfile.ZipFile(source) as archive:
+        yield lambda name: io.TextIOWrapper(archive.open(name), encoding='utf-8-sig', newline='')
+
+
+def read_gtfs(source, routes) -> ImportResult:
+    # routes: route_id GTFS → (туда, обратно); рейсы других route_id пропускаются
+    collector = _Collector()
+    with _gtfs_opener(source) as open_member:
+        services = {}
+        with open_member('calendar.txt') as f:
+            for row in csv.DictReader(f):
+                days = []
+                if any(row.get(column) == '1' for column in WEEKDAY_COLUMNS):
+                    days.append('будни')
+                if row.get('saturday') == '1':
+                    days.append('суббота')
+                services[row['service_id']] = tuple(days)
+
+        trips = {}
+        unknown = set()
+        with open_member('trips.txt') as f:
+            for line, row in enumerate(csv.DictReader(f), start=2):
+                pair = routes.get(row.get('route_id'))
+                days = services.get(row.get('service_id'), ())
+                if pair is None:
+                    # О каждом чужом маршруте — одна ошибка, остальные его рейсы только считаются
+                    if row.get('route_id') in unknown:
+                        collector.skipped += 1
+                    else:
+                        unknown.add(row.get('route_id'))
+                        collector.error(f"trips.txt:{line}", f"маршрут «{row.get('route_id')}» не настроен")
+                elif days:
+                    trips[row['trip_id']] = (days, pair[int(row.get('direction_id') or 0) % 2])
+
+        # Самый большой файл: из каждой строки берём только первую остановку рейса
+        first = {}
+        with open_member('stop_times.txt') as f:
+            for line, row in enumerate(csv.DictReader(f), start=2):
+                trip_id = row.get('trip_id')
+                if trip_id not in trips:
+                    continue
+                try:
+                    seq = int(row.get('stop_sequence') or 0)
+                except ValueError:
+                    collector.error(f"stop_times.txt:{line}", f"неверный stop_sequence «{row.get('stop_sequence')}»")
+                    continue
+                known = first.get(trip_id)
+                if known is None or seq < known[0]:
+                    first[trip_id] = (seq, row.get('departure_time') or row.get('arrival_time') or '', line)
+
+    for trip_id, (_, time_text, line) in first.items():
+        days, direction = trips[trip_id]
+        for day in days:
+            collector.add(f"stop_times.txt:{line}", day, direction, time_text)
+    return collector.result()
+
+
+def detect_format(name: str) -> str:
+    suffix = Path(name).suffix.lower()
+    if suffix == '.csv':
+        return 'csv'
+    if suffix == '.json':
+        return 'json'
+    if suffix == '.zip' or Path(name).is_dir():
+        return 'gtfs'
+    raise ValueError(f"Неизвестный формат: {name} (нужен .csv, .json или GTFS .zip)")
+
+
+def import_timetable(source, fmt, routes, directions=None) -> ImportResult:
+    # source — путь или байты; routes — route_id GTFS → (туда, обратно);
+    # directions — допустимые направления CSV/JSON (None — любые)
+    if fmt == 'gtfs':
+        if not routes:
+            raise ValueError("маршруты GTFS не сопоставлены: задайте 'gtfs_route_id' в 'маршруты' или --route")
+        return read_gtfs(io.BytesIO(source) if isinstance(source, bytes) else source, routes)
+    if isinstance(source, bytes):
+        stream = io.StringIO(source.decode('utf-8-sig'), newline='')
+    else:
+        stream = open(source, newline='', encoding='utf-8-sig')
+    with stream:
+        return (read_csv if fmt == 'csv' else read_json)(stream, directions)
+
+
+def write_csv(base, stream):
+    writer = csv.writer(stream)
+    writer.writerow(['day', 'direction', 'time'])
+    for day in DAY_TYPES:
+        for direction, times in base.get(day, {}).items():
+            writer.writerows([day, direction, t] for t in times)
+
+
+def write_gtfs(base, stream, routes):
+    direction_ids = {d: (route_id, i) for route_id, pair in routes.items() for i, d in enumerate(pair)}
+    tables = {name: io.StringIO(newline='') for name in ('calendar', 'routes', 'stops', 'trips', 'stop_times')}
+    writers = {name: csv.writer(f) for name, f in tables.items()}
+    writers['calendar'].writerow(['service_id', *WEEKDAY_COLUMNS, 'saturday', 'sunday', 'start_date', 'end_date'])
+    writers['calendar'].writerow(['будни', 1, 1, 1, 1, 1, 0, 0, '20000101', '20991231'])
+    writers['calendar'].writerow(['суббота', 0, 0, 0, 0, 0, 1, 0, '20000101', '20991231'])
+    writers['routes'].writerow(['route_id', 'route_short_name', 'route_type'])
+    writers['routes'].writerows([route_id, route_id, 3] for route_id in routes if route_id is not None)
+    writers['stops'].writerow(['stop_id', 'stop_name', 'stop_lat', 'stop_lon'])
+    writers['stops'].writerows([d.split('→')[0], d.split('→')[0], '', ''] for d in direction_ids)
+    writers['trips'].writerow(['route_id', 'service_id', 'trip_id', 'direction_id'])
+    writers['stop_times'].writerow(['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence'])
+    for day in DAY_TYPES:
+        for direction, times in base.get(day, {}).items():
+            if direction not in direction_ids:
+                continue
+            route_id, direction_id = direction_ids[direction]
+            for t in times:
+                trip_id = f"{day}-{direction}-{t}"
+                writers['trips'].writerow([route_id, day, trip_id, direction_id])
+                writers['stop_times'].writerow([trip_id, f"{t}:00", f"{t}:00", direction.split('→')[0], 1])
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, f in tables.items():
+            archive.writestr(f'{name}.txt', f.getvalue())
+
+
+def export_timetable(base, fmt, routes) -> bytes:
+    if fmt == 'gtfs':
+        buffer = io.BytesIO()
+        write_gtfs(base, buffer, routes)
+        return buffer.getvalue()
+    if fmt == 'json':
+        return json.dumps(base, ensure_ascii=False, indent=2).encode('utf-8')
+    text = io.StringIO(newline='')
+    write_csv(base, text)
+    return text.getvalue().encode('utf-8')
+
+
+def routes_of(data, mapping=()):
+    # → (наш маршрут → (туда, обратно), route_id GTFS → (туда, обратно))
+    # Без раздела 'маршруты' — один маршрут 'main' из первых двух направлений будней.
+    # mapping — пары (route_id GTFS, наш маршрут) из --route, поверх 'gtfs_route_id'
+    routes_cfg = data.get('маршруты') or {}
+    if routes_cfg:
+        pairs = {route_id: tuple(cfg['направления']) for route_id, cfg in routes_cfg.items()}
+    else:
+        directions = tuple(data['базовое_расписание'].get('будни', {}))[:2]
+        pairs = {'main': directions} if len(directions) == 2 else {}
+    gtfs = {cfg['gtfs_route_id']: pairs[route_id] for route_id, cfg in routes_cfg.items() if cfg.get('gtfs_route_id')}
+    for gtfs_id, route_id in mapping:
+        if route_id not in pairs:
+            raise ValueError(f"Нет маршрута «{route_id}», есть: {', '.join(pairs)}")
+        gtfs[gtfs_id] = pairs[route_id]
+    return pairs, gtfs
+
+
+def export_routes(pairs, gtfs):
+    # Для выгрузки: route_id GTFS, если сопоставлен, иначе наш
+    by_pair = {pair: gtfs_id for gtfs_id, pair in gtfs.items()}
+    return {by_pair.get(pair, route_id): pair for route_id, pair in pairs.items()}
+
+
+def parse_route_option(text):
+    # '101=main' → ('101', 'main')
+    gtfs_id, sep, route_id = text.partition('=')
+    if not sep or not gtfs_id or not route_id:
+        raise argparse.ArgumentTypeError(f"ожидалось GTFS_ROUTE_ID=МАРШРУТ, получено «{text}»")
+    return gtfs_id, route_id
+
+
+# 🖥️ python timetable_io.py import season.zip | export schedule.csv
+# Пишет прямо в хранилище — запускать при остановленном боте (или загрузить файл админом в боте)
+def main():
+    from store import apply_patch, make_backend
+
+    parser = argparse.ArgumentParser(description='Импорт и экспорт расписания')
+    parser.add_argument('command', choices=['import', 'export'])
+    parser.add_argument('file')
+    parser.add_argument('--backend', choices=['sqlite', 'json'], default='sqlite')
+    parser.add_argument('--db', default='schedule.sqlite3')
+    parser.add_argument('--json', default='schedule.json')
+    parser.add_argument('--format', choices=['csv', 'json', 'gtfs'])
+    parser.add_argument('--route', action='append', default=[], type=parse_route_option, metavar='GTFS_ROUTE_ID=МАРШРУТ',
+                        help="сопоставить route_id из GTFS нашему маршруту (можно несколько раз)")
+    args = parser.parse_args()
+
+    backend = make_backend(args.backend, Path(args.json), Path(args.db))
+    try:
+        data = backend.read()
+        try:
+            pairs, gtfs = routes_of(data, args.route)
+            fmt = args.format or detect_format(args.file)
+            if args.command == 'export':
+                Path(args.file).write_bytes(export_timetable(data['базовое_расписание'], fmt, export_routes(pairs, gtfs)))
+                print(f"✅ Расписание выгружено в {args.file}")
+                return
+            directions = {d for pair in pairs.values() for d in pair} or None
+            result = import_timetable(args.file, fmt, gtfs, directions)
+        except ValueError as e:
+            sys.exit(f"❌ {e}")
+        for error in result.errors:
+            print(f"⚠️ {error}", file=sys.stderr)
+        if not result.rows:
+            sys.exit(f"❌ Ничего не загружено, пропущено строк: {result.skipped}")
+        ops = [
+            ('set', ('базовое_расписание', day, direction), times)
+            for day, by_direction in result.base.items()
+            for direction, times in by_direction.items()
+        ]
+        if apply_patch(data, ops):
+            backend.write(backend.snapshot(data))
+        print(f"✅ Загружено рейсов: {result.rows}, пропущено строк: {result.skipped}")
+    finally:
+        backend.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+import json
+import asyncio
+import logging
+from array import array
+from datetime import datetime
+from pathlib import Path
+
+from geo import np
+from timetable_io import DAY_TYPES
+
+log = logging.getLogger(__name__)
+
+# 🗂️ История рейсов: каталог на маршрут, по файлу на колонку, строки только дописываются
+# Сводка помнит, сколько строк уже учла, и читает (через numpy.memmap) только новые
+COLUMNS = (
+    ('day', 'I', '<u4'),        # date.toordinal() дня отправления
+    ('kind', 'B', 'u1'),        # индекс в DAY_TYPES
+    ('direction', 'B', 'u1'),   # 0 — туда, 1 — обратно
+    ('planned', 'H', '<u2'),    # минута отправления по расписанию, NO_PLAN — рейс не опознан
+    ('departed', 'd', '<f8'),   # unix-время отправления
+    ('duration', 'f', '<f4'),   # секунд в пути
+)
+NO_PLAN = 0xFFFF
+
+TERMINAL_PCT = 3                      # ближе к концу маршрута — автобус на конечной
+MIN_TRIP_SEC, MAX_TRIP_SEC = 120, 4 * 3600
+MATCH_MIN = 30                        # рейс по расписанию ищем в пределах ± получаса
+ON_TIME_MIN = (-1, 5)                 # «вовремя»: не раньше минуты и не позже пяти
+MIN_SAMPLES = 5                       # меньше рейсов — статистике не верим
+
+
+def quantile(counts, q):
+    # counts: {значение: сколько раз} → q-квантиль
+    total = sum(counts.values())
+    seen = 0
+    for value in sorted(counts):
+        seen += counts[value]
+        if seen >= q * total:
+            return value
+    return None
+
+
+class TripLog:
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+
+    def _path(self, name):
+        return self.directory / f'{name}.col'
+
+    def __len__(self):
+        # После сбоя посреди записи колонки могут разойтись — считаем по самой короткой
+        sizes = []
+        for name, code, _ in COLUMNS:
+            path = self._path(name)
+            sizes.append(path.stat().st_size // array(code).itemsize if path.exists() else 0)
+        return min(sizes)
+
+    def append(self, rows):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        size = len(self)
+        for i, (name, code, _) in enumerate(COLUMNS):
+            with open(self._path(name), 'ab') as f:
+                f.truncate(size * array(code).itemsize)
+                array(code, [row[i] for row in rows]).tofile(f)
+
+    def read(self, start=0):
+        # → (всего строк, {колонка: значения со строки start})
+        end = len(self)
+        columns = {}
+        for name, code, dtype in COLUMNS:
+            itemsize = array(code).itemsize
+            if end <= start:
+                columns[name] = array(code)
+            elif np is not None:
+                columns[name] = np.memmap(self._path(name), dtype=dtype, mode='r', offset=start * itemsize, shape=(end - start,))
+            else:
+                columns[name] = array(code)
+                with open(self._path(name), 'rb') as f:
+                    f.seek(start * itemsize)
+                    columns[name].fromfile(f, end - start)
+        return end, columns
+
+
+# 📊 Распределения по (тип дня, направление, рейс): опоздание и время в пути, минуты
+# Ключ с рейсом None — все рейсы направления вместе
+class TripStats:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.cursor = 0
+        self.version = 0
+        self.delays = {}
+        self.durations = {}
+
+    @staticmethod
+    def _dump_key(key):
+        kind, direction, planned = key
+        return f"{kind}|{direction}|{'*' if planned is None else planned}"
+
+    @staticmethod
+    def _load_key(text):
+        kind, direction, planned = text.split('|')
+        return kind, int(direction), None if planned == '*' else int(planned)
+
+    def load(self):
+        if not self.path.exists():
+            return
+        data = json.loads(self.path.read_text(encoding='utf-8'))
+        self.cursor = data['cursor']
+        for name in ('delays', 'durations'):
+            setattr(self, name, {
+                self._load_key(key): {int(v): n for v, n in counts.items()} for key, counts in data[name].items()
+            })
+
+    def save(self):
+        data = {'cursor': self.cursor}
+        for name in ('delays', 'durations'):
+            data[name] = {self._dump_key(key): counts for key, counts in getattr(self, name).items()}
+        tmp = self.path.with_suffix('.tmp')
+        tmp.write_text(json.dumps(data, ensure_ascii=False), encoding='utf-8')
+        tmp.replace(self.path)
+
+    @staticmethod
+    def count(columns):
+        # Новые строки → приращения распределений; считается в потоке, без общего состояния
+        delays, durations = {}, {}
+        names = [name for name, _, _ in COLUMNS]
+        rows = zip(*(columns[name].tolist() for name in names))
+        for day, kind, direction, planned, departed, duration in rows:
+            kind = DAY_TYPES[kind]
+            minutes = round(duration / 60)
+            keys = [(kind, direction, None)]
+            late = None
+            if planned != NO_PLAN:
+                keys.append((kind, direction, planned))
+                dt = datetime.fromtimestamp(departed)
+                late = round(dt.hour * 60 + dt.minute + dt.second / 60 - planned)
+            for key in keys:
+                bucket = durations.setdefault(key, {})
+                bucket[minutes] = bucket.get(minutes, 0) + 1
+                if late is not None:
+                    bucket = delays.setdefault(key, {})
+                    bucket[late] = bucket.get(late, 0) + 1
+        return delays, durations
+
+    def merge(self, cursor, delays, durations):
+        for target, source in ((self.delays, delays), (self.durations, durations)):
+            for key, counts in source.items():
+                bucket = target.setdefault(key, {})
+                for value, n in counts.items():
+                    bucket[value] = bucket.get(value, 0) + n
+        self.cursor = cursor
+        if delays or durations:
+            self.version += 1
+
+    def _spread(self, table, kind, direction, planned):
+        counts = table.get((kind, direction, planned))
+        if not counts or sum(counts.values()) < MIN_SAMPLES:
+            return None
+        return quantile(counts, 0.5), quantile(counts, 0.9)
+
+    def delay(self, kind, direction, planned=None):
+        # → (медиана, p90) опоздания в минутах или None
+        return self._spread(self.delays, kind, direction, planned)
+
+    def duration(self, kind, direction, planned=None):
+        # → (медиана, p90) времени в пути в минутах или None
+        return self._spread(self.durations, kind, direction, planned)
+
+    def on_time(self, kind):
+        # → (вовремя, всего) по всем рейсам этого типа дня
+        early, late = ON_TIME_MIN
+        good = total = 0
+        for (k, _, planned), counts in self.delays.items():
+            if k != kind or planned is not None:
+                continue
+            total += sum(counts.values())
+            good += sum(n for v, n in counts.items() if early <= v <= late)
+        return good, total
+
+
+# 🏁 Рейсы из отметок: выехал с одной конечной — доехал до другой
+class TripHistory:
+    def __init__(self, directory: Path, plan, interval=60):
+        # plan(направление, 'YYYY-MM-DD') → (тип дня, отсортированные минуты отправлений)
+        self.directory = Path(directory)
+        self.plan = plan
+        self.interval = interval
+        self._routes = {}    # маршрут → (TripLog, TripStats)
+        self._pending = {}   # маршрут → строки, ещё не записанные на диск
+        self._state = {}     # автобус → (у какой конечной, когда там видели последний раз)
+
+    def load(self, routes):
+        for info in routes.values():
+            directory = self.directory / info.id
+            stats = TripStats(directory / 'stats.json')
+            stats.load()
+            self._routes[info.id] = (TripLog(directory), stats)
+
+    def stats(self, route_id) -> TripStats:
+        return self._routes[route_id][1]
+
+    def feed(self, vehicle, sample):
+        # Подписчик FixChannel
+        if sample.progress <= TERMINAL_PCT:
+            at = 0
+        elif sample.progress >= 100 - TERMINAL_PCT:
+            at = 1
+        else:
+            return
+        state = self._state.get(vehicle.id)
+        if state is not None and state[0] != at:
+            self._complete(vehicle.route, state[0], state[1], sample.time)
+        self._state[vehicle.id] = (at, sample.time)
+
+    def _complete(self, info, direction, departed, arrived):
+        if not MIN_TRIP_SEC <= arrived - departed <= MAX_TRIP_SEC:
+            return
+        dt = datetime.fromtimestamp(departed)
+        kind, departures = self.plan(info.directions[direction], dt.strftime('%Y-%m-%d'))
+        if kind not in DAY_TYPES:
+            return
+        minute = dt.hour * 60 + dt.minute + dt.second / 60
+        planned = min(departures, key=lambda m: abs(m - minute), default=None)
+        if planned is None or abs(planned - minute) > MATCH_MIN:
+            planned = NO_PLAN
+        row = (dt.toordinal(), DAY_TYPES.index(kind), direction, planned, departed, arrived - departed)
+        self._pending.setdefault(info.id, []).append(row)
+
+    def _sync(self, route_id, rows):
+        # В потоке: дописать рейсы и посчитать всё, что сводка ещё не видела
+        trip_log, stats = self._routes[route_id]
+        if rows:
+            trip_log.append(rows)
+        cursor, columns = trip_log.read(stats.cursor)
+        return (cursor, *TripStats.count(columns))
+
+    async def update(self):
+        pending, self._pending = self._pending, {}
+        try:
+            for route_id, (_, stats) in self._routes.items():
+                rows = pending.pop(route_id, [])
+                try:
+                    cursor, delays, durations = await asyncio.to_thread(self._sync, route_id, rows)
+                except Exception:
+                    pending[route_id] = rows
+                    raise
+                if cursor != stats.cursor:
+                    stats.merge(cursor, delays, durations)
+                    await asyncio.to_thread(stats.save)
+        finally:
+            # Не записанное (сбойный маршрут и все после него) — в следующее обновление
+            for route_id, rows in pending.items():
+                self._pending.setdefault(route_id, [])[:0] = rows
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.update()
+            except Exception:
+                log.exception("Ошибка обновления статистики рейсов")